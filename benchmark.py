@@ -0,0 +1,219 @@
+from __future__ import division
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import scipy.misc
+
+from utils import get_image
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--out', type=str, default='benchmark.json')
+parser.add_argument('--workDir', type=str, default=None)
+parser.add_argument('--trainBatchSizes', type=int, nargs='+', default=[16, 64])
+parser.add_argument('--trainCores', type=int, nargs='*', default=[1, 2, 4])
+parser.add_argument('--trainSteps', type=int, default=20)
+parser.add_argument('--trainWarmup', type=int, default=5)
+parser.add_argument('--decodeImages', type=int, default=512)
+parser.add_argument('--completeImageSizes', type=int, nargs='+', default=[128, 256])
+parser.add_argument('--completeBatchSizes', type=int, nargs='+', default=[16, 64])
+parser.add_argument('--completeMethods', type=str, nargs='+', default=['adam'])
+parser.add_argument('--completeImages', type=int, default=2)
+parser.add_argument('--nIter', type=int, default=50)
+parser.add_argument('--coldStartRuns', type=int, default=3)
+parser.add_argument('--initCheckpoint', type=str, default=None, help=argparse.SUPPRESS)
+
+
+def init_checkpoint(checkpoint_dir):
+    # Saves a randomly initialized DCGAN so completion can run without a trained model.
+    import tensorflow as tf
+    from model import DCGAN
+
+    with tf.Session() as sess:
+        dcgan = DCGAN(sess, image_size=64, batch_size=64, checkpoint_dir=checkpoint_dir)
+        tf.global_variables_initializer().run()
+        dcgan.save(checkpoint_dir, 0)
+
+
+def run(cmd, cwd, cores=None):
+    # Runs a child process and returns (seconds, peak RSS in MB) for that child
+    # alone. `cores` pins the child to the first N CPUs it is allowed to use.
+    def pin():
+        if cores is not None:
+            os.sched_setaffinity(0, sorted(os.sched_getaffinity(0))[:cores])
+
+    start = time.time()
+    proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, preexec_fn=pin)
+    output = proc.stdout.read()
+    _, status, rusage = os.wait4(proc.pid, 0)
+    elapsed = time.time() - start
+    if status != 0:
+        sys.stderr.write(output.decode(errors='replace'))
+        raise RuntimeError("{} exited with status {}".format(' '.join(cmd), status))
+    return elapsed, rusage.ru_maxrss / 1024.
+
+
+def make_images(root, n, size, holes=False, seed=0):
+    if not os.path.exists(root):
+        os.makedirs(root)
+    rng = np.random.RandomState(seed)
+    paths = []
+    for i in range(n):
+        image = rng.randint(0, 256, size=(size, size, 3)).astype(np.uint8)
+        if holes:
+            x, y = rng.randint(0, size - size // 4, size=2)
+            image[x:x + size // 4, y:y + size // 4] = [255, 0, 255]
+        path = os.path.join(root, '{:05d}.png'.format(i))
+        scipy.misc.imsave(path, image)
+        paths.append(path)
+    return paths
+
+
+def bench_decode(args, work):
+    files = make_images(os.path.join(work, 'decode'), args.decodeImages, 64)
+    start = time.time()
+    for f in files:
+        get_image(f, 64, is_crop=False)
+    elapsed = time.time() - start
+    return {'bench': 'decode', 'images': len(files), 'seconds': elapsed, 'images_per_sec': len(files) / elapsed}
+
+
+def bench_train(args, work, batch_size, cores=None):
+    # With `cores`, the run is pinned to that many CPUs and trains one
+    # single-threaded tower per core.
+    dataset = os.path.join(work, 'train-data')
+    n = (args.trainWarmup + args.trainSteps) * batch_size
+    if not os.path.exists(dataset) or len(os.listdir(dataset)) < n:
+        make_images(dataset, n, 64)
+
+    def steps(count):
+        out = os.path.join(work, 'train-{}-{}-{}'.format(batch_size, cores, count))
+        if not os.path.exists(out):
+            os.makedirs(out)
+        cmd = [sys.executable, os.path.join(ROOT, 'train-dcgan.py'), '--epoch', '1',
+               '--batch_size', str(batch_size), '--train_size', str(count * batch_size),
+               '--dataset', dataset, '--checkpoint_dir', os.path.join(out, 'checkpoint'),
+               '--sample_dir', os.path.join(out, 'samples')]
+        if cores is not None:
+            cmd += ['--num_towers', str(cores), '--intra_op_threads', '1', '--inter_op_threads', str(cores)]
+        return run(cmd, out, cores)
+
+    # Graph construction and session start-up cancel out in the difference.
+    warm, _ = steps(args.trainWarmup)
+    total, rss = steps(args.trainWarmup + args.trainSteps)
+    step_time = max(total - warm, 1e-9) / args.trainSteps
+    return {'bench': 'train', 'batch_size': batch_size, 'cores': cores, 'steps': args.trainSteps,
+            'steps_per_sec': 1 / step_time, 'images_per_sec': batch_size / step_time, 'peak_rss_mb': rss}
+
+
+def bench_complete(args, work, checkpoint_dir, image_size, batch_size, method):
+    name = 'complete-{}-{}-{}'.format(method, image_size, batch_size)
+    out = os.path.join(work, name)
+    imgs = make_images(os.path.join(out, 'inputs'), args.completeImages, image_size, holes=True)
+    stats_path = os.path.join(out, 'stats.json')
+    cmd = [sys.executable, os.path.join(ROOT, 'complete.py'), '--method', method,
+           '--batchSize', str(batch_size), '--nIter', str(args.nIter), '--plateauWindow', '0',
+           '--traceStride', '0', '--checkpointDir', checkpoint_dir, '--outDir', out,
+           '--stats', stats_path] + imgs
+    elapsed, rss = run(cmd, out)
+    with open(stats_path) as f:
+        stats = json.load(f)
+    result = {'bench': 'complete', 'method': method, 'image_size': image_size, 'batch_size': batch_size,
+              'wall_seconds': elapsed, 'peak_rss_mb': rss}
+    result.update(stats)
+    return result
+
+
+def bench_cold_start(args, work, checkpoint_dir):
+    # Launch-to-ready time and peak RSS of complete.py on one small image,
+    # restoring the training checkpoint versus loading the frozen export.
+    out = os.path.join(work, 'cold-start')
+    frozen = os.path.join(out, 'completion.pb')
+    imgs = make_images(os.path.join(out, 'inputs'), 1, 64, holes=True)
+    run([sys.executable, os.path.join(ROOT, 'export-completion.py'), '--checkpointDir', checkpoint_dir,
+         '--out', frozen], out)
+
+    results = []
+    for mode, extra in [('checkpoint', ['--checkpointDir', checkpoint_dir]), ('frozen', ['--frozen', frozen])]:
+        startup, wall, rss = [], [], []
+        for _ in range(args.coldStartRuns):
+            stats_path = os.path.join(out, 'stats-{}.json'.format(mode))
+            elapsed, peak = run([sys.executable, os.path.join(ROOT, 'complete.py'), '--nIter', '1',
+                                 '--traceStride', '0', '--outDir', out, '--stats', stats_path] + extra + imgs, out)
+            with open(stats_path) as f:
+                startup.append(json.load(f)['startup_seconds'])
+            wall.append(elapsed)
+            rss.append(peak)
+        results.append({'bench': 'cold_start', 'mode': mode, 'runs': args.coldStartRuns,
+                        'startup_seconds': float(np.median(startup)), 'wall_seconds': float(np.median(wall)),
+                        'peak_rss_mb': float(np.median(rss))})
+    return results
+
+
+def main(args):
+    if args.initCheckpoint:
+        init_checkpoint(args.initCheckpoint)
+        return
+
+    work = args.workDir or tempfile.mkdtemp(prefix='dcgan-bench-')
+    results = []
+    try:
+        results.append(bench_decode(args, work))
+        print(results[-1])
+
+        for batch_size in args.trainBatchSizes:
+            results.append(bench_train(args, work, batch_size))
+            print(results[-1])
+
+        # Data-parallel scaling curve: images/sec against pinned core count.
+        scaling = []
+        for cores in args.trainCores:
+            if cores > len(os.sched_getaffinity(0)) or 64 % cores:
+                continue
+            scaling.append(bench_train(args, work, 64, cores))
+            scaling[-1]['speedup'] = scaling[-1]['images_per_sec'] / scaling[0]['images_per_sec']
+            print(scaling[-1])
+        results += scaling
+
+        checkpoint_dir = os.path.join(work, 'checkpoint')
+        run([sys.executable, os.path.abspath(__file__), '--initCheckpoint', checkpoint_dir], work)
+        for result in bench_cold_start(args, work, checkpoint_dir):
+            results.append(result)
+            print(result)
+        for method in args.completeMethods:
+            for image_size in args.completeImageSizes:
+                for batch_size in args.completeBatchSizes:
+                    results.append(bench_complete(args, work, checkpoint_dir, image_size, batch_size, method))
+                    print(results[-1])
+    finally:
+        if args.workDir is None:
+            shutil.rmtree(work, ignore_errors=True)
+
+    import tensorflow as tf
+    report = {
+        'env': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count() if hasattr(os, 'cpu_count') else None,
+            'numpy': np.__version__,
+            'tensorflow': tf.__version__,
+        },
+        'results': results,
+    }
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=1)
+    print("wrote {}".format(args.out))
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -0,0 +1,17 @@
+import argparse
+import time
+
+from dataset import build_dataset
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--imageSize', type=int, default=64)
+parser.add_argument('--isCrop', action='store_true')
+parser.add_argument('--shardSize', type=int, default=4096)
+parser.add_argument('src', type=str)
+parser.add_argument('out', type=str)
+
+args = parser.parse_args()
+
+start_time = time.time()
+index = build_dataset(args.src, args.out, image_size=args.imageSize, is_crop=args.isCrop, shard_size=args.shardSize)
+print("packed {} images into {} shards in {:.2f}s".format(index["count"], len(index["shards"]), time.time() - start_time))
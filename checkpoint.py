@@ -0,0 +1,84 @@
+from __future__ import division
+
+import os
+import threading
+from glob import glob
+
+import tensorflow as tf
+from six.moves import cPickle
+
+
+# Writes checkpoints from a background thread. `save` copies the live
+# variables into shadow copies with one sess.run between training steps, so
+# the checkpoint is a consistent snapshot, and the slow Saver write then reads
+# only the shadows while training continues. Checkpoints use the live
+# variables' names, so a plain Saver can restore them. Each checkpoint has a
+# pickled `.state` file next to it for the non-TensorFlow training state.
+class AsyncCheckpointer(object):
+    def __init__(self, sess, var_list, checkpoint_dir, model_name, max_to_keep=1, keep_every_hours=10000.):
+        self.sess = sess
+        self.checkpoint_dir = checkpoint_dir
+        self.prefix = os.path.join(checkpoint_dir, model_name)
+
+        with tf.variable_scope('checkpoint_shadow'):
+            shadows = [tf.Variable(tf.zeros(v.get_shape(), v.dtype.base_dtype), trainable=False,
+                                   name=v.op.name.replace('/', '_'), collections=[tf.GraphKeys.LOCAL_VARIABLES])
+                       for v in var_list]
+        self.snapshot = tf.group(*[tf.assign(s, v) for s, v in zip(shadows, var_list)])
+        self.saver = tf.train.Saver(var_list=dict((v.op.name, s) for v, s in zip(var_list, shadows)),
+                                    max_to_keep=max_to_keep, keep_checkpoint_every_n_hours=keep_every_hours)
+        sess.run(tf.variables_initializer(shadows))
+
+        self._thread = None
+        self._error = None
+
+    def save(self, step, state):
+        # Only one write is in flight, since it reads the shadows.
+        self.wait()
+        self.sess.run(self.snapshot)
+        self._thread = threading.Thread(target=self._write, args=(step, state))
+        self._thread.start()
+
+    def _write(self, step, state):
+        try:
+            if not os.path.exists(self.checkpoint_dir):
+                os.makedirs(self.checkpoint_dir)
+            # The state goes first: the `checkpoint` index written by the Saver
+            # must never point at a checkpoint that has no state yet.
+            path = '{}-{}'.format(self.prefix, step)
+            with open(path + '.state', 'wb') as f:
+                cPickle.dump(state, f, protocol=2)
+            self.saver.save(self.sess, self.prefix, global_step=step)
+            for state_file in glob(self.prefix + '-*.state'):
+                if not tf.train.checkpoint_exists(state_file[:-len('.state')]):
+                    os.remove(state_file)
+        except Exception as e:
+            self._error = e
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+
+def restore(sess, checkpoint_dir, var_list):
+    # Restores whichever of `var_list` the latest checkpoint has (older
+    # checkpoints only hold model weights) and returns (path, state); state is
+    # None when the checkpoint has no `.state` file.
+    ckpt = tf.train.get_checkpoint_state(checkpoint_dir)
+    if not (ckpt and ckpt.model_checkpoint_path):
+        return None, None
+    path = ckpt.model_checkpoint_path
+    available = set(name for name, _ in tf.train.list_variables(path))
+    restorable = [v for v in var_list if v.op.name in available]
+    tf.train.Saver(var_list=restorable).restore(sess, path)
+    print("restored {} of {} variables from {}".format(len(restorable), len(var_list), path))
+
+    state = None
+    if os.path.exists(path + '.state'):
+        with open(path + '.state', 'rb') as f:
+            state = cPickle.load(f)
+    return path, state
@@ -1,6 +1,14 @@
+import time
+start_time = time.time()
+
 import argparse
+import json
+import os
+
 import tensorflow as tf
 
+from dataset import dataset_files
+from frozen import PRECISIONS, FrozenCompletionModel, compare_precision
 from model import DCGAN
 
 parser = argparse.ArgumentParser()
@@ -13,19 +21,60 @@ parser.add_argument('--hmcEps', type=float, default=0.001)
 parser.add_argument('--hmcL', type=int, default=100)
 parser.add_argument('--hmcAnneal', type=float, default=1)
 parser.add_argument('--nIter', type=int, default=1200)
+parser.add_argument('--minIter', type=int, default=200)
+parser.add_argument('--plateauWindow', type=int, default=100)
+parser.add_argument('--plateauTol', type=float, default=1e-3)
+parser.add_argument('--gradTol', type=float, default=0)
+parser.add_argument('--method', type=str, default='adam', choices=['adam', 'graph-adam', 'hmc'])
+parser.add_argument('--graphSteps', type=int, default=50)
 parser.add_argument('--imgSize', type=int, default=64)
+parser.add_argument('--batchSize', type=int, default=64)
 parser.add_argument('--lam', type=float, default=0.1)
 parser.add_argument('--checkpointDir', type=str, default='checkpoint')
+parser.add_argument('--frozen', type=str, default=None)
+parser.add_argument('--precision', type=str, default='float32', choices=PRECISIONS)
+parser.add_argument('--comparePrecision', action='store_true')
 parser.add_argument('--outDir', type=str, default='completions')
 parser.add_argument('--outInterval', type=int, default=50)
+parser.add_argument('--traceStride', type=int, default=1)
 parser.add_argument('--centerScale', type=float, default=0.25)
-parser.add_argument('imgs', type=str, nargs='+')
+parser.add_argument('--restarts', type=int, default=1)
+parser.add_argument('--latentCache', type=int, default=0)
+parser.add_argument('--outOfCore', action='store_true')
+parser.add_argument('--storeBlock', type=int, default=256)
+parser.add_argument('--stats', type=str, default=None)
+parser.add_argument('--serve', type=str, default=None)
+parser.add_argument('--batchWindow', type=float, default=10)
+parser.add_argument('imgs', type=str, nargs='*')
 
 args = parser.parse_args()
+if args.frozen and args.method != 'adam':
+    parser.error('--frozen only supports --method adam')
+if args.comparePrecision and not args.frozen:
+    parser.error('--comparePrecision needs a --frozen graph')
+# Rounded weights only lose accuracy at runtime, so they are a study, not a serving mode.
+if args.comparePrecision == (args.precision == 'float32'):
+    parser.error('--precision bfloat16/int8 goes with --comparePrecision, and only there')
+args.imgs = [f for img in args.imgs for f in (sorted(dataset_files(img)) if os.path.isdir(img) else [img])]
 
 config = tf.ConfigProto(allow_soft_placement = True)
 config.gpu_options.allow_growth = True
-with tf.device('/gpu:0'):
-    with tf.Session(config=config) as sess:
-        dcgan = DCGAN(sess, image_size=args.imgSize, batch_size=min(64, len(args.imgs)), checkpoint_dir=args.checkpointDir, lam=args.lam)
-        dcgan.complete(args)
+if args.comparePrecision:
+    stats = compare_precision(args.frozen, args)
+else:
+    with tf.device('/gpu:0'):
+        with tf.Session(config=config) as sess:
+            if args.frozen:
+                dcgan = FrozenCompletionModel(sess, args.frozen, batch_size=args.batchSize)
+            else:
+                dcgan = DCGAN(sess, image_size=args.imgSize, batch_size=args.batchSize, checkpoint_dir=args.checkpointDir, lam=args.lam)
+            if args.serve:
+                dcgan.serve(args)
+            else:
+                stats = dcgan.complete(args)
+                stats['startup_seconds'] = dcgan.ready_time - start_time
+                print("[Startup] model ready {:.2f}s after launch".format(stats['startup_seconds']))
+
+if args.stats:
+    with open(args.stats, 'w') as f:
+        json.dump(stats, f, indent=1)
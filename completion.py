@@ -0,0 +1,724 @@
+from __future__ import division
+
+import collections
+import hashlib
+import os
+import time
+
+import numpy as np
+from six.moves import xrange
+
+from tilestore import TiledArray, TiledImage
+from utils import get_image, hole_pixels
+from writer import flush_images, save_images
+
+
+def spiral_tiles(shape, size=64, step=50):
+    # Bottom-right corners (maxX, maxY) of the tiles in the order DCGAN.complete
+    # has always visited them.
+    a = 0
+    b = 0
+    queue1 = list()
+    queue2 = list()
+    queue3 = list()
+    queue4 = list()
+    n = shape[0]
+    m = shape[1]
+
+    while a <= m and b <= m:
+        def func(x, y, q):
+            mxX = min(x + size, shape[0])
+            mxY = min(y + size, shape[1])
+            if len(q) == 0 or q[-1] != (mxX, mxY):
+                q.append((mxX, mxY))
+            return mxX, mxY
+
+        for k in xrange(a, n, step):
+            func(k, b, queue1)
+        for k in xrange(b + step, m, step):
+            func(n, k, queue2)
+        for k in xrange(n - step, a, -step):
+            func(k, n, queue3)
+        for k in xrange(m - step, b + step, -step):
+            func(a, k, queue4)
+
+        a += step
+        b += step
+        n -= step
+        m -= step
+
+    queue1.reverse()
+    queue2.reverse()
+    queue3.reverse()
+    queue4.reverse()
+    return queue1 + queue2 + queue3 + queue4
+
+
+class HoleIndex(object):
+    # Hole pixels of one image plus a summed-area table over the holes it
+    # started with. Holes only ever disappear as tiles are completed, so a
+    # zero count in the table means a tile can be skipped without looking at
+    # its pixels.
+    def __init__(self, image, size=64):
+        self.size = size
+        self.c_dim = image.shape[2]
+        self.holes = hole_pixels(image)
+        self.table = np.zeros((self.holes.shape[0] + 1, self.holes.shape[1] + 1), dtype=np.int64)
+        self.table[1:, 1:] = self.holes.cumsum(0).cumsum(1)
+
+    def count(self, tile):
+        maxX, maxY = tile
+        minX, minY = max(maxX - self.size, 0), max(maxY - self.size, 0)
+        t = self.table
+        return t[maxX, maxY] - t[minX, maxY] - t[maxX, minY] + t[minX, minY]
+
+    def mask(self, tile):
+        # 1 where the generator must match the image, 0 over remaining holes.
+        maxX, maxY = tile
+        holes = self.holes[maxX - self.size:maxX, maxY - self.size:maxY]
+        if not holes.any():
+            return None
+        return np.repeat(~holes[:, :, None], self.c_dim, 2).astype(np.float64)
+
+    def fill(self, tile):
+        maxX, maxY = tile
+        self.holes[maxX - self.size:maxX, maxY - self.size:maxY] = False
+
+
+class TiledHoleIndex(HoleIndex):
+    # HoleIndex for a TiledImage. The hole bitmap is a TiledArray next to the
+    # image, and the summed-area table is replaced by a hole count per block:
+    # tiles over hole-free blocks are rejected without reading the bitmap.
+    def __init__(self, image, size=64):
+        self.size = size
+        self.c_dim = image.shape[2]
+        self.holes = TiledArray(os.path.splitext(image.path)[0] + '_holes.npy', image.shape[:2],
+                                dtype=np.bool_, block=image.block)
+        self.counts = np.zeros(image.grid, dtype=np.int64)
+        b = image.block
+        for i in xrange(image.grid[0]):
+            for j in xrange(image.grid[1]):
+                holes = hole_pixels(image[i * b:(i + 1) * b, j * b:(j + 1) * b])
+                self.holes[i * b:(i + 1) * b, j * b:(j + 1) * b] = holes
+                self.counts[i, j] = holes.sum()
+
+    def count(self, tile):
+        maxX, maxY = tile
+        minX, minY = max(maxX - self.size, 0), max(maxY - self.size, 0)
+        b = self.holes.block
+        if not self.counts[minX // b:(maxX - 1) // b + 1, minY // b:(maxY - 1) // b + 1].any():
+            return 0
+        return int(self.holes[minX:maxX, minY:maxY].sum())
+
+
+def overlaps(a, b, size=64):
+    return abs(a[0] - b[0]) < size and abs(a[1] - b[1]) < size
+
+
+class TileScheduler(object):
+    # Hands out (image, tile) jobs once every earlier tile (in spiral order) of
+    # the same image that overlaps them has been completed. Jobs that are ready
+    # at the same time never overlap, so they can share a generator batch, and
+    # each tile still sees the neighbours it would have seen in spiral order.
+    def __init__(self, size=64):
+        self.size = size
+        self.tiles = {}
+        self.remaining = {}
+        self.ready = collections.deque()
+        self._waiting = {}
+        self._dependents = {}
+
+    def add_image(self, key, tiles):
+        # Images without tiles are finished by the caller straight away, so
+        # only images with outstanding tiles are counted.
+        if tiles:
+            self.remaining[key] = len(tiles)
+        cells = {}
+        for k, tile in enumerate(tiles):
+            job = (key, k)
+            self.tiles[job] = tile
+            self._dependents[job] = []
+            cx, cy = tile[0] // self.size, tile[1] // self.size
+            deps = 0
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    for other in cells.get((cx + dx, cy + dy), ()):
+                        if overlaps(tile, self.tiles[other], self.size):
+                            self._dependents[other].append(job)
+                            deps += 1
+            cells.setdefault((cx, cy), []).append(job)
+            if deps:
+                self._waiting[job] = deps
+            else:
+                self.ready.append(job)
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def take(self):
+        return self.ready.popleft()
+
+    def done(self, job):
+        del self.tiles[job]
+        for dep in self._dependents.pop(job):
+            self._waiting[dep] -= 1
+            if self._waiting[dep] == 0:
+                del self._waiting[dep]
+                self.ready.append(dep)
+        self.remaining[job[0]] -= 1
+        if self.remaining[job[0]]:
+            return False
+        del self.remaining[job[0]]
+        return True
+
+
+class LatentCache(object):
+    # LRU cache of optimised latents. Every completed tile is stored under its
+    # position, so later tiles that overlap it can start from its z, and under
+    # a hash of its input pixels and mask, so an exact repeat is answered with
+    # the stored completion without running the optimiser.
+    def __init__(self, capacity, size=64):
+        self.capacity = capacity
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self._cells = {}
+
+        self.lookups = 0
+        self.hits = 0
+        self.warm_starts = 0
+        self.hit_iters = 0
+
+    @staticmethod
+    def digest(pixels, mask):
+        h = hashlib.sha1(np.ascontiguousarray(pixels, dtype=np.float32).tobytes())
+        h.update(np.packbits(mask[..., 0] > 0).tobytes())
+        return h.hexdigest()
+
+    def _cell(self, image, tile):
+        return image, tile[0] // self.size, tile[1] // self.size
+
+    def _touch(self, key):
+        value = self.entries.pop(key, None)
+        if value is not None:
+            self.entries[key] = value
+        return value
+
+    def lookup(self, digest):
+        # (completed tile, iterations it took) for an exact repeat, else None.
+        self.lookups += 1
+        entry = self._touch(('hash', digest))
+        if entry is not None:
+            self.hits += 1
+            self.hit_iters += entry[1]
+        return entry
+
+    def neighbour(self, image, tile):
+        # z of the cached tile of the same image that overlaps `tile` the most.
+        cx, cy = self._cell(image, tile)[1:]
+        best, best_area = None, 0
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for other in self._cells.get((image, cx + dx, cy + dy), ()):
+                    area = (max(self.size - abs(tile[0] - other[0]), 0) *
+                            max(self.size - abs(tile[1] - other[1]), 0))
+                    if area > best_area:
+                        best, best_area = other, area
+        if best is None:
+            return None
+        self.warm_starts += 1
+        return self._touch(('pos', image, best))
+
+    def put(self, image, tile, digest, z, completed, iters):
+        for key, value in [(('pos', image, tile), z.copy()), (('hash', digest), (completed.copy(), iters))]:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+        self._cells.setdefault(self._cell(image, tile), set()).add(tile)
+        while len(self.entries) > self.capacity:
+            key, _ = self.entries.popitem(last=False)
+            if key[0] == 'pos':
+                cell = self._cell(key[1], key[2])
+                self._cells[cell].discard(key[2])
+                if not self._cells[cell]:
+                    del self._cells[cell]
+
+
+class SlotAdam(object):
+    # Adam on a batch of latents in which every slot keeps its own step count,
+    # so one slot can be restarted without disturbing the others.
+    def __init__(self, shape, lr, beta1, beta2, eps):
+        self.lr = lr
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.eps = eps
+        self.m = np.zeros(shape)
+        self.v = np.zeros(shape)
+        self.t = np.zeros((shape[0], 1))
+
+    def reset(self, slot):
+        self.m[slot] = 0
+        self.v[slot] = 0
+        self.t[slot] = 0
+
+    def step(self, z, g):
+        self.t += 1
+        self.m = self.beta1 * self.m + (1 - self.beta1) * g
+        self.v = self.beta2 * self.v + (1 - self.beta2) * np.multiply(g, g)
+        m_hat = self.m / (1 - self.beta1 ** self.t)
+        v_hat = self.v / (1 - self.beta2 ** self.t)
+        z -= np.true_divide(self.lr * m_hat, (np.sqrt(v_hat) + self.eps))
+        np.clip(z, -1, 1, out=z)
+
+
+class ConvergenceMonitor(object):
+    # Per-slot stopping rule: a slot is done after `max_iter` iterations, or,
+    # once it has run `min_iter`, when its loss has not improved by a relative
+    # `tol` for `window` iterations or its gradient norm drops below
+    # `grad_tol`. A zero `window` or `grad_tol` disables that test.
+    def __init__(self, n, max_iter, min_iter=0, window=0, tol=0., grad_tol=0.):
+        self.max_iter = max_iter
+        self.min_iter = min_iter
+        self.window = window
+        self.tol = tol
+        self.grad_tol = grad_tol
+        self.iters = np.zeros(n, dtype=np.int64)
+        self.best = np.full(n, np.inf)
+        self.since = np.zeros(n, dtype=np.int64)
+
+    def reset(self, slot):
+        self.iters[slot] = 0
+        self.best[slot] = np.inf
+        self.since[slot] = 0
+
+    def remaining(self, slots):
+        return int(np.min(self.max_iter - self.iters[slots]))
+
+    def update(self, loss, grad_norm, steps=1):
+        self.iters += steps
+        improved = loss < self.best * (1 - self.tol)
+        self.since = np.where(improved, 0, self.since + steps)
+        self.best = np.where(improved, loss, self.best)
+
+        done = self.iters >= self.max_iter
+        warm = self.iters >= self.min_iter
+        if self.window > 0:
+            done |= warm & (self.since >= self.window)
+        if self.grad_tol > 0:
+            done |= warm & (grad_norm < self.grad_tol)
+        return done
+
+
+TRACE_MAGIC = b'DCGT'
+
+
+def trace_dtype(z_dim):
+    return np.dtype([('iter', '<i4'), ('image', '<i4'), ('tile', '<i4'), ('slot', '<i4'),
+                     ('loss', '<f4'), ('z', '<f4', (z_dim,))])
+
+
+class TraceWriter(object):
+    # Appends fixed-width (iter, image, tile, slot, loss, z) records to one
+    # open file, buffering `chunk` records between writes and keeping only
+    # every `stride`-th iteration.
+    def __init__(self, path, z_dim, stride=1, chunk=4096):
+        self.stride = stride
+        self.buf = np.zeros(chunk, dtype=trace_dtype(z_dim))
+        self.n = 0
+        self.f = open(path, 'wb')
+        self.f.write(TRACE_MAGIC + np.array([z_dim], dtype='<u4').tobytes())
+
+    def record(self, iters, jobs, loss, z, span=1):
+        # `iters` holds each slot's own iteration count; `span` > 1 when one
+        # record stands for iterations i - span + 1 .. i. Empty slots are None.
+        if self.stride <= 0:
+            return
+        for slot, job in enumerate(jobs):
+            i = iters[slot]
+            if job is None or i // self.stride == (i - span) // self.stride:
+                continue
+            if self.n == len(self.buf):
+                self.flush()
+            r = self.buf[self.n]
+            r['iter'], r['image'], r['tile'], r['slot'] = i, job[0], job[1], slot
+            r['loss'] = loss[slot]
+            r['z'] = z[slot]
+            self.n += 1
+
+    def flush(self):
+        self.f.write(self.buf[:self.n].tobytes())
+        self.n = 0
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+
+def read_trace(path):
+    with open(path, 'rb') as f:
+        header = f.read(len(TRACE_MAGIC) + 4)
+        assert header[:len(TRACE_MAGIC)] == TRACE_MAGIC, "not a completion trace: {}".format(path)
+        z_dim = int(np.frombuffer(header[len(TRACE_MAGIC):], dtype='<u4')[0])
+        return np.fromfile(f, dtype=trace_dtype(z_dim))
+
+
+# Continuous-batching completion engine. Every generator slot runs its own
+# tile until it converges, then is committed to its image and refilled with
+# the next ready tile of any image. Images may be added between steps.
+class Completer(object):
+    def __init__(self, dcgan, config, out_dir=None):
+        self.dcgan = dcgan
+        self.config = config
+        self.out_dir = out_dir
+        self.size = dcgan.image_size
+        self.tile_step = 50
+        self.lowres_mask = np.zeros(dcgan.lowres_shape)
+
+        self.scheduler = TileScheduler(self.size)
+        self.images = {}
+        self.holes = {}
+        self.names = {}
+        self.callbacks = {}
+
+        n = self.n_slots = dcgan.batch_size
+        self.slots = [None] * n
+        self.batch_images = np.zeros([n] + dcgan.image_shape, dtype=np.float32)
+        self.masks = np.ones([n] + dcgan.image_shape)
+        self.zhats = np.zeros((n, dcgan.z_dim))
+        self.adam = SlotAdam(self.zhats.shape, config.lr, config.beta1, config.beta2, config.eps)
+        self.monitor = ConvergenceMonitor(n, config.nIter, config.minIter,
+                                          config.plateauWindow, config.plateauTol, config.gradTol)
+        self.cache = LatentCache(config.latentCache, self.size) if config.latentCache > 0 else None
+        self.digests = [None] * n
+        self.restarts = {}
+        self.best = {}
+        self.warm = np.zeros(n, dtype=bool)
+        self.trace = None
+        if out_dir and config.traceStride > 0:
+            self.trace = TraceWriter(os.path.join(out_dir, 'logs/trace.bin'), dcgan.z_dim, stride=config.traceStride)
+
+        # Only occupied slots are fed to the generator; results are spread back
+        # into these slot-indexed arrays.
+        self.loss = np.zeros(n)
+        self.g_norm = np.zeros(n)
+        self.grads = np.zeros_like(self.zhats)
+        self.G_imgs = np.zeros_like(self.batch_images)
+        self.hmc_accepts = np.zeros(n)
+        self.hmc_beta = np.zeros(n)
+
+        self.n_images = 0
+        self.n_tiles = 0
+        self.n_tile_iters = 0
+        self.n_cold_runs = 0
+        self.n_cold_iters = 0
+        self.n_steps = 0
+        self.busy = 0
+        self.start_time = time.time()
+
+    def add_image(self, key, image, callback, name=None):
+        holes = TiledHoleIndex(image, self.size) if isinstance(image, TiledImage) else HoleIndex(image, self.size)
+        tiles = [tile for tile in spiral_tiles(image.shape, self.size, self.tile_step) if holes.count(tile)]
+        self.images[key] = image
+        self.holes[key] = holes
+        self.names[key] = key if name is None else name
+        self.callbacks[key] = callback
+        self.n_images += 1
+        self.scheduler.add_image(key, tiles)
+        if not tiles:
+            self._finish(key)
+
+    def clear(self):
+        # Drops every image and tile in flight without calling their callbacks.
+        self.scheduler = TileScheduler(self.size)
+        self.slots = [None] * self.n_slots
+        for table in [self.images, self.holes, self.names, self.callbacks, self.restarts, self.best]:
+            table.clear()
+
+    def pending(self):
+        return len(self.scheduler) + sum(slot is not None for slot in self.slots)
+
+    def _finish(self, key):
+        image = self.images.pop(key)
+        del self.holes[key], self.names[key]
+        self.callbacks.pop(key)(key, image)
+
+    def _next_job(self):
+        # Next ready tile that still has holes, as (job, mask, pixels, digest).
+        # Tiles the cache has seen before are completed on the spot.
+        size = self.size
+        while self.scheduler.ready:
+            job = self.scheduler.take()
+            maxX, maxY = self.scheduler.tiles[job]
+            mask = self.holes[job[0]].mask((maxX, maxY))
+            if mask is not None:
+                pixels = self.images[job[0]][maxX - size:maxX, maxY - size:maxY, :]
+                if self.cache is None:
+                    return job, mask, pixels, None
+                digest = self.cache.digest(pixels, mask)
+                hit = self.cache.lookup(digest)
+                if hit is None:
+                    return job, mask, pixels, digest
+                self.images[job[0]][maxX - size:maxX, maxY - size:maxY, :] = hit[0]
+                self.holes[job[0]].fill((maxX, maxY))
+                self.n_tiles += 1
+            if self.scheduler.done(job):
+                self._finish(job[0])
+        return None, None, None, None
+
+    def _fill(self):
+        fresh = []
+        for slot in xrange(self.n_slots):
+            if self.slots[slot] is not None:
+                continue
+            job, mask, pixels, digest = self._next_job()
+            if job is None:
+                break
+            self.slots[slot] = job
+            self.digests[slot] = digest
+            self.batch_images[slot] = pixels
+            self.masks[slot] = mask
+            z = None if self.cache is None else self.cache.neighbour(job[0], self.scheduler.tiles[job])
+            self.warm[slot] = z is not None
+            self.zhats[slot] = z if z is not None else np.random.uniform(-1, 1, size=self.dcgan.z_dim)
+            self.adam.reset(slot)
+            self.monitor.reset(slot)
+            self.restarts[job] = [slot]
+            fresh.append(slot)
+
+        # Slots left over once the ready queue is empty run extra random
+        # restarts of the tiles started above, spread round-robin; with a full
+        # batch every tile gets a single run.
+        spare = [slot for slot in xrange(self.n_slots) if self.slots[slot] is None]
+        started = list(fresh)
+        for _ in xrange(self.config.restarts - 1):
+            for first in started:
+                if not spare:
+                    break
+                slot = spare.pop(0)
+                job = self.slots[first]
+                self.slots[slot] = job
+                self.digests[slot] = self.digests[first]
+                self.batch_images[slot] = self.batch_images[first]
+                self.masks[slot] = self.masks[first]
+                self.warm[slot] = False
+                self.zhats[slot] = np.random.uniform(-1, 1, size=self.dcgan.z_dim)
+                self.adam.reset(slot)
+                self.monitor.reset(slot)
+                self.restarts[job].append(slot)
+                fresh.append(slot)
+        return fresh
+
+    def _commit(self, slot):
+        # Frees a converged slot. The tile is written once all of its restarts
+        # have converged, from the one with the lowest loss.
+        size = self.size
+        job = self.slots[slot]
+        key = job[0]
+        maxX, maxY = self.scheduler.tiles[job]
+        iters = int(self.monitor.iters[slot])
+        best = self.best.get(job)
+        if best is None or self.loss[slot] < best['loss']:
+            self.best[job] = best = {
+                'loss': self.loss[slot], 'z': self.zhats[slot].copy(), 'iters': iters,
+                'completed': self.masks[slot] * self.batch_images[slot] + (1.0 - self.masks[slot]) * self.G_imgs[slot],
+                'accepts': self.hmc_accepts[slot], 'beta': self.hmc_beta[slot],
+            }
+        self.n_tile_iters += iters
+        if not self.warm[slot]:
+            self.n_cold_runs += 1
+            self.n_cold_iters += iters
+        self.slots[slot] = None
+        self.restarts[job].remove(slot)
+        if self.restarts[job]:
+            return
+
+        del self.restarts[job], self.best[job]
+        self.images[key][maxX - size:maxX, maxY - size:maxY, :] = best['completed']
+        self.holes[key].fill((maxX, maxY))
+        if best['loss'] > 700:
+            print("[Complete] {} tile {}: loss {:.2f} did not converge".format(
+                self.names[key], (maxX, maxY), best['loss']))
+        if self.config.method == 'hmc':
+            print("[HMC] {} tile {}: {:d} transitions, {:.1%} accepted, final beta {:.4g}".format(
+                self.names[key], (maxX, maxY), best['iters'],
+                best['accepts'] / max(best['iters'], 1), best['beta']))
+        if self.cache is not None:
+            self.cache.put(key, (maxX, maxY), self.digests[slot], best['z'], best['completed'], best['iters'])
+        self.n_tiles += 1
+        if self.scheduler.done(job):
+            self._finish(key)
+
+    def _save_inputs(self, fresh):
+        d = self.dcgan
+        grid = [np.ceil(len(fresh) / 8), min(8, len(fresh))]
+        save_images(self.batch_images[fresh], grid, os.path.join(self.out_dir, 'before.png'))
+        save_images(np.multiply(self.batch_images, self.masks)[fresh], grid, os.path.join(self.out_dir, 'masked.png'))
+        if self.lowres_mask.any():
+            lowres_images = np.reshape(self.batch_images[fresh],
+                                       [len(fresh), d.lowres_size, d.lowres, d.lowres_size,
+                                        d.lowres, d.c_dim]).mean(4).mean(2)
+            lowres_images = np.multiply(lowres_images, self.lowres_mask)
+            lowres_images = np.repeat(np.repeat(lowres_images, d.lowres, 1), d.lowres, 2)
+            save_images(lowres_images, grid, os.path.join(self.out_dir, 'lowres.png'))
+
+    def step(self):
+        # Runs one batched iteration (or one in-graph chunk) over the occupied
+        # slots. Returns False once there is nothing left to do.
+        d = self.dcgan
+        config = self.config
+        sess = d.sess
+        fresh = self._fill()
+        active = [slot for slot in xrange(self.n_slots) if self.slots[slot] is not None]
+        if not active:
+            return False
+
+        if fresh and self.out_dir:
+            self._save_inputs(fresh)
+
+        i = self.n_steps
+        loss, g_norm, zhats, G_imgs = self.loss, self.g_norm, self.zhats, self.G_imgs
+        if fresh and config.method in ('graph-adam', 'hmc'):
+            reset = [d.latent_reset] + ([d.hmc_reset] if config.method == 'hmc' else [])
+            sess.run(reset, feed_dict={
+                d.latent_slots: fresh, d.z: zhats[fresh], d.images: self.batch_images[fresh],
+                d.mask: self.masks[fresh], d.lowres_mask: self.lowres_mask})
+
+        if config.method == 'hmc':
+            k = 1
+            fd = {d.latent_active: active, d.is_training: False}
+            loss[active], g_norm[active], self.hmc_accepts, self.hmc_beta = sess.run(
+                [d.hmc_loss, d.hmc_grad_norm, d.hmc_accepts_after, d.hmc_beta_after], feed_dict=fd)
+            zhats[:] = sess.run(d.latent_z)
+            converged = self.monitor.update(loss, g_norm)
+            snapshot = i % config.outInterval == 0
+            if snapshot or converged[active].any():
+                G_imgs[active] = sess.run(d.latent_G, feed_dict=fd)
+        elif config.method == 'graph-adam':
+            k = min(config.graphSteps, config.outInterval - i % config.outInterval, self.monitor.remaining(active))
+            fd = {d.latent_active: active, d.latent_steps: k, d.is_training: False}
+            loss[active], g_norm[active], _ = sess.run(
+                [d.latent_loss, d.latent_grad_norm, d.latent_update], feed_dict=fd)
+            zhats[:] = sess.run(d.latent_z)
+            converged = self.monitor.update(loss, g_norm, k)
+            snapshot = i // config.outInterval != (i + k) // config.outInterval
+            if snapshot or converged[active].any():
+                G_imgs[active] = sess.run(d.latent_G, feed_dict=fd)
+        else:
+            k = 1
+            fd = {
+                d.z: zhats[active],
+                d.mask: self.masks[active],
+                d.lowres_mask: self.lowres_mask,
+                d.images: self.batch_images[active],
+                d.is_training: False
+            }
+            loss[active], g, G_imgs[active] = sess.run([d.complete_loss, d.grad_complete_loss, d.G], feed_dict=fd)
+            self.grads[:] = 0
+            self.grads[active] = g[0]
+            g_norm[active] = np.linalg.norm(g[0], axis=1)
+            converged = self.monitor.update(loss, g_norm)
+            snapshot = i % config.outInterval == 0
+
+        if self.trace is not None:
+            self.trace.record(self.monitor.iters - 1, self.slots, loss, zhats, span=k)
+        if config.method == 'adam':
+            self.adam.step(zhats, self.grads)
+
+        self.n_steps += k
+        self.busy += len(active) * k
+
+        if snapshot and self.out_dir:
+            print(i, np.mean(loss[active]))
+            completed = self.masks * self.batch_images + (1.0 - self.masks) * G_imgs
+            imgName = os.path.join(self.out_dir, 'completed/{:04d}.png'.format(i))
+            save_images(completed[active], [np.ceil(len(active) / 8), min(8, len(active))], imgName)
+
+        for slot in active:
+            if converged[slot]:
+                self._commit(slot)
+        return True
+
+    def run(self):
+        while self.step():
+            pass
+
+    def close(self):
+        if self.trace is not None:
+            self.trace.close()
+
+    def report(self):
+        elapsed = time.time() - self.start_time
+        stats = {
+            'method': self.config.method,
+            'images': self.n_images,
+            'tiles': self.n_tiles,
+            'seconds': elapsed,
+            'tiles_per_sec': self.n_tiles / max(elapsed, 1e-9),
+            'iterations_per_sec': self.n_steps / max(elapsed, 1e-9),
+            'slot_iterations_per_sec': self.busy / max(elapsed, 1e-9),
+            'iterations_per_tile': self.n_tile_iters / max(self.n_tiles, 1),
+            'slot_occupancy': self.busy / max(self.n_steps * self.n_slots, 1),
+        }
+        if self.cache is not None:
+            # Warm starts are credited with the gap to the average cold-started tile.
+            c = self.cache
+            cold_iters = self.n_cold_iters / max(self.n_cold_runs, 1)
+            warm_iters = (self.n_tile_iters - self.n_cold_iters) / max(c.warm_starts, 1)
+            stats.update({
+                'cache_hits': c.hits,
+                'cache_hit_rate': c.hits / max(c.lookups, 1),
+                'warm_starts': c.warm_starts,
+                'iterations_saved': c.hit_iters + max(cold_iters - warm_iters, 0) * c.warm_starts,
+            })
+        return stats
+
+
+def complete_images(model, config):
+    # Completes every image in config.imgs with `model` (a DCGAN, or anything
+    # exposing the same completion tensors) and writes completed/<name>.png,
+    # where <name> is the input's index and base name, e.g. 00003_face, so
+    # inputs sharing a base name never collide. With config.outOfCore each
+    # image is instead kept in a uint8 TiledImage under store/ and written to
+    # completed/<name>.npy.
+    for name in ['completed', 'logs', 'store']:
+        p = os.path.join(config.outDir, name)
+        if not os.path.exists(p):
+            os.makedirs(p)
+
+    def base(key):
+        return '{:05d}_{}'.format(key, os.path.splitext(os.path.basename(config.imgs[key]))[0])
+
+    def load(key):
+        if not config.outOfCore:
+            return get_image(config.imgs[key], model.image_size, is_crop=model.is_crop)
+        path = os.path.join(config.outDir, 'store/{}.npy'.format(base(key)))
+        return TiledImage.load(config.imgs[key], path, block=config.storeBlock)
+
+    def save(key, image):
+        if isinstance(image, TiledImage):
+            image.export(os.path.join(config.outDir, 'completed/{}.npy'.format(base(key))))
+            # The scratch image and its hole bitmap are no longer needed.
+            for p in [image.path, os.path.splitext(image.path)[0] + '_holes.npy']:
+                os.remove(p)
+            return
+        imgName = os.path.join(config.outDir, 'completed/{}.png'.format(base(key)))
+        save_images(np.array([image]).astype(np.float32), [1, 1], imgName)
+
+    # One queue of (image, tile) jobs across all inputs; batch slots are
+    # filled from whichever images have tiles ready.
+    completer = Completer(model, config, out_dir=config.outDir)
+    try:
+        for key, img in enumerate(config.imgs):
+            completer.add_image(key, load(key), save, name=img)
+        completer.run()
+    finally:
+        # Flushes the trace even when completion fails part way.
+        completer.close()
+    flush_images()
+
+    stats = completer.report()
+    print("[Complete] {method} {images:d} images, {tiles:d} tiles in {seconds:.2f}s ({tiles_per_sec:.2f} tiles/sec, "
+          "{slot_iterations_per_sec:.2f} slot-iterations/sec), {iterations_per_tile:.1f} iterations/tile, "
+          "{slot_occupancy:.1%} slot occupancy".format(**stats))
+    if 'cache_hits' in stats:
+        print("[Cache] {cache_hits:d} exact hits ({cache_hit_rate:.1%} of lookups), {warm_starts:d} warm starts, "
+              "~{iterations_saved:.0f} iterations saved".format(**stats))
+    return stats
@@ -0,0 +1,167 @@
+from __future__ import division
+
+import itertools
+import json
+import multiprocessing
+import os
+from glob import glob
+
+import numpy as np
+
+from utils import center_crop, hole_pixels, imread
+
+SUPPORTED_EXTENSIONS = ["png", "jpg", "jpeg"]
+INDEX_FILE = "index.json"
+
+
+def dataset_files(root):
+    return list(itertools.chain.from_iterable(
+        glob(os.path.join(root, "*.{}".format(ext))) for ext in SUPPORTED_EXTENSIONS))
+
+
+def is_packed_dataset(root):
+    return os.path.isfile(os.path.join(root, INDEX_FILE))
+
+
+def write_packed(out_dir, images, image_size=64, shard_size=4096):
+    # Packs (name, uint8 image) pairs into shards under out_dir.
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    shape = (image_size, image_size, 3)
+    shards = []
+    packed_files = []
+
+    def flush(images):
+        name = "shard_{:05d}.npy".format(len(shards))
+        shard = np.lib.format.open_memmap(os.path.join(out_dir, name), mode='w+', dtype=np.uint8,
+                                          shape=(len(images),) + shape)
+        shard[:] = np.stack(images)
+        shard.flush()
+        del shard
+        shards.append({"file": name, "count": len(images)})
+
+    pending = []
+    for name, image in images:
+        pending.append(image)
+        packed_files.append(name)
+        if len(pending) == shard_size:
+            flush(pending)
+            pending = []
+    if pending:
+        flush(pending)
+
+    index = {
+        "image_size": image_size,
+        "c_dim": 3,
+        "count": len(packed_files),
+        "shards": shards,
+        "files": packed_files,
+    }
+    with open(os.path.join(out_dir, INDEX_FILE), 'w') as f:
+        json.dump(index, f, indent=1)
+    return index
+
+
+def build_dataset(root, out_dir, image_size=64, is_crop=False, shard_size=4096):
+    shape = (image_size, image_size, 3)
+
+    def images():
+        for path in sorted(dataset_files(root)):
+            image = imread(path)
+            if is_crop:
+                image = center_crop(image, image_size)
+            if image.shape != shape:
+                print("skipping {}: shape {} != {}".format(path, image.shape, shape))
+                continue
+            yield os.path.relpath(path, root), np.asarray(image).astype(np.uint8)
+
+    return write_packed(out_dir, images(), image_size, shard_size)
+
+
+def patch_corners(shape, size=64, stride=64):
+    # Top-left corners of the size x size patches every `stride` pixels; the
+    # last row and column are shifted back to end at the image border.
+    xs = np.unique(np.minimum(np.arange(0, shape[0], stride), shape[0] - size))
+    ys = np.unique(np.minimum(np.arange(0, shape[1], stride), shape[1] - size))
+    return np.stack(np.meshgrid(xs, ys, indexing='ij'), -1).reshape(-1, 2)
+
+
+def extract_patches(image, size=64, stride=64):
+    # Patches of a uint8 image that contain no magenta hole pixel, their
+    # corners, and how many patches were rejected.
+    if image.shape[0] < size or image.shape[1] < size:
+        return np.zeros((0, size, size, 3), dtype=np.uint8), np.zeros((0, 2), dtype=np.int64), 0
+    corners = patch_corners(image.shape, size, stride)
+    holes = hole_pixels(image.astype(np.float32) / 127.5 - 1.)
+    table = np.zeros((holes.shape[0] + 1, holes.shape[1] + 1), dtype=np.int64)
+    table[1:, 1:] = holes.cumsum(0).cumsum(1)
+    x, y = corners[:, 0], corners[:, 1]
+    counts = table[x + size, y + size] - table[x, y + size] - table[x + size, y] + table[x, y]
+    rejected = int(np.count_nonzero(counts))
+    corners = corners[counts == 0]
+    d = np.arange(size)
+    patches = image[corners[:, 0, None, None] + d[:, None], corners[:, 1, None, None] + d[None, :]]
+    return patches, corners, rejected
+
+
+def _file_patches(job):
+    path, size, stride = job
+    return (path,) + extract_patches(np.asarray(imread(path)).astype(np.uint8), size, stride)
+
+
+def extract_dataset(root, out_dir, size=64, stride=64, shard_size=4096, workers=None):
+    # Packs every hole-free patch of every image under root, with images
+    # decoded and cut on `workers` processes (all cores by default). Patches
+    # are named <file>@<x>,<y>.
+    files = sorted(dataset_files(root))
+    stats = {"images": len(files), "rejected": 0}
+    pool = multiprocessing.Pool(workers)
+
+    def images():
+        for path, patches, corners, rejected in pool.imap(_file_patches, [(f, size, stride) for f in files], 4):
+            stats["rejected"] += rejected
+            name = os.path.relpath(path, root)
+            for patch, (x, y) in zip(patches, corners):
+                yield "{}@{:d},{:d}".format(name, x, y), patch
+
+    try:
+        index = write_packed(out_dir, images(), size, shard_size)
+    finally:
+        pool.terminate()
+        pool.join()
+    stats["patches"] = index["count"]
+    return index, stats
+
+
+class PackedDataset(object):
+    def __init__(self, root):
+        with open(os.path.join(root, INDEX_FILE)) as f:
+            self.index = json.load(f)
+        self.image_size = self.index["image_size"]
+        self.shards = [np.load(os.path.join(root, s["file"]), mmap_mode='r') for s in self.index["shards"]]
+        self.offsets = np.cumsum([0] + [len(s) for s in self.shards])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def take(self, indices):
+        indices = np.asarray(indices)
+        start, stop = indices[0], indices[-1] + 1
+        shard = np.searchsorted(self.offsets, start, 'right') - 1
+        # A contiguous run inside one shard is a view on the mapping.
+        if stop - start == len(indices) and stop <= self.offsets[shard + 1] and \
+                np.array_equal(indices, np.arange(start, stop)):
+            return self.shards[shard][start - self.offsets[shard]:stop - self.offsets[shard]]
+
+        out = np.empty((len(indices),) + self.shards[0].shape[1:], dtype=np.uint8)
+        shard_ids = np.searchsorted(self.offsets, indices, 'right') - 1
+        for s in np.unique(shard_ids):
+            pos = np.flatnonzero(shard_ids == s)
+            # Read each shard in ascending row order to keep page faults sequential.
+            pos = pos[np.argsort(indices[pos])]
+            out[pos] = self.shards[s][indices[pos] - self.offsets[s]]
+        return out
+
+    def batch(self, indices):
+        return self.take(indices).astype(np.float32) / 127.5 - 1.
@@ -0,0 +1,22 @@
+import argparse
+
+import tensorflow as tf
+
+from frozen import export_frozen
+from model import DCGAN
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--imgSize', type=int, default=64)
+parser.add_argument('--lam', type=float, default=0.1)
+parser.add_argument('--checkpointDir', type=str, default='checkpoint')
+parser.add_argument('--out', type=str, default='checkpoint/completion.pb')
+
+args = parser.parse_args()
+
+with tf.Session() as sess:
+    dcgan = DCGAN(sess, image_size=args.imgSize, checkpoint_dir=args.checkpointDir, lam=args.lam, inference=True)
+    isLoaded = dcgan.load(args.checkpointDir)
+    assert isLoaded
+    full = len(sess.graph.as_graph_def().node)
+    graph_def = export_frozen(dcgan, args.out)
+    print("wrote {}: {} of {} graph nodes kept".format(args.out, len(graph_def.node), full))
@@ -0,0 +1,23 @@
+import argparse
+import time
+
+from dataset import extract_dataset
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--patchSize', type=int, default=64)
+parser.add_argument('--stride', type=int, default=64)
+parser.add_argument('--shardSize', type=int, default=4096)
+parser.add_argument('--workers', type=int, default=None)
+parser.add_argument('src', type=str)
+parser.add_argument('out', type=str)
+
+args = parser.parse_args()
+
+start_time = time.time()
+index, stats = extract_dataset(args.src, args.out, size=args.patchSize, stride=args.stride,
+                               shard_size=args.shardSize, workers=args.workers)
+elapsed = time.time() - start_time
+print("packed {} patches from {} images ({} rejected for holes) into {} shards in {:.2f}s".format(
+    stats["patches"], stats["images"], stats["rejected"], len(index["shards"]), elapsed))
+print("{:.2f} images/sec, {:.2f} patches/sec".format(stats["images"] / max(elapsed, 1e-9),
+                                                    (stats["patches"] + stats["rejected"]) / max(elapsed, 1e-9)))
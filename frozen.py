@@ -0,0 +1,194 @@
+from __future__ import division
+
+import json
+import time
+
+import numpy as np
+import tensorflow as tf
+from six.moves import xrange
+from tensorflow.python.framework import tensor_util
+
+from completion import Completer, HoleIndex, SlotAdam, complete_images, spiral_tiles
+from server import serve
+from utils import get_image
+
+PRECISIONS = ['float32', 'bfloat16', 'int8']
+
+
+def export_frozen(dcgan, path):
+    # Freezes the completion loss of an inference-mode DCGAN into a single
+    # GraphDef. Only the ops G, complete_loss and its gradient w.r.t. z depend
+    # on survive: the generator, the fake-image discriminator branch and the
+    # losses. The real-image branch, summaries, optimizers and Saver are pruned.
+    assert dcgan.inference, "export needs a DCGAN built with inference=True"
+    outputs = [
+        tf.identity(dcgan.G, name='frozen_G'),
+        tf.identity(dcgan.complete_loss, name='frozen_complete_loss'),
+        tf.identity(dcgan.grad_complete_loss[0], name='frozen_grad_complete_loss'),
+    ]
+    graph_def = tf.graph_util.convert_variables_to_constants(
+        dcgan.sess, dcgan.sess.graph.as_graph_def(), [t.op.name for t in outputs])
+    with tf.gfile.GFile(path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+
+    meta = {
+        'inputs': dict((name, t.name) for name, t in [('z', dcgan.z), ('images', dcgan.images),
+                                                       ('mask', dcgan.mask), ('lowres_mask', dcgan.lowres_mask)]),
+        'outputs': dict((name, t.name) for name, t in zip(['G', 'complete_loss', 'grad_complete_loss'], outputs)),
+        'image_size': dcgan.image_size,
+        'z_dim': dcgan.z_dim,
+        'c_dim': dcgan.c_dim,
+        'lowres': dcgan.lowres,
+        'lam': dcgan.lam,
+    }
+    with open(path + '.json', 'w') as f:
+        json.dump(meta, f, indent=1)
+    return graph_def
+
+
+def round_weights(graph_def, precision):
+    # Rounds every float32 weight constant of a frozen graph (rank 2 and up:
+    # conv kernels and linear matrices) to what bfloat16 (round to nearest
+    # even) or int8 with one scale per slice along the last axis can
+    # represent, and stores it back as float32. Only the accuracy changes:
+    # the graph, its arithmetic and its speed are those of the float32 graph.
+    if precision == 'float32':
+        return graph_def
+    out = tf.GraphDef()
+    out.CopyFrom(graph_def)
+    for node in out.node:
+        tensor = node.attr['value'].tensor
+        if node.op != 'Const' or node.attr['dtype'].type != tf.float32.as_datatype_enum or \
+                len(tensor.tensor_shape.dim) < 2:
+            continue
+        w = tensor_util.MakeNdarray(tensor).astype(np.float32)
+        if precision == 'bfloat16':
+            bits = w.view(np.uint32).astype(np.uint64)
+            bits = ((bits + 0x7fff + ((bits >> 16) & 1)) >> 16) << 16
+            w = bits.astype(np.uint32).view(np.float32)
+        else:
+            scale = np.abs(w).reshape(-1, w.shape[-1]).max(0) / 127.
+            scale[scale == 0] = 1.
+            w = (np.clip(np.rint(w / scale), -127, 127) * scale).astype(np.float32)
+        tensor.CopyFrom(tensor_util.make_tensor_proto(w, dtype=tf.float32))
+    return out
+
+
+# Serves the completion interface of DCGAN (the tensors Completer uses with
+# the NumPy Adam method) from a graph written by export_frozen.
+class FrozenCompletionModel(object):
+    def __init__(self, sess, path, batch_size=64, precision='float32'):
+        with open(path + '.json') as f:
+            meta = json.load(f)
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        graph_def = round_weights(graph_def, precision)
+
+        inputs = ['z', 'images', 'mask', 'lowres_mask']
+        outputs = ['G', 'complete_loss', 'grad_complete_loss']
+        tensors = tf.import_graph_def(graph_def, name='frozen', return_elements=
+                                      [meta['inputs'][n] for n in inputs] + [meta['outputs'][n] for n in outputs])
+        self.z, self.images, self.mask, self.lowres_mask, self.G, self.complete_loss, grad = tensors
+        self.grad_complete_loss = [grad]
+        # Batch norm is already fixed to inference mode; this only keeps the
+        # feed dicts shared with DCGAN valid.
+        self.is_training = tf.placeholder_with_default(False, [], name='is_training')
+
+        self.sess = sess
+        self.precision = precision
+        self.batch_size = batch_size
+        self.is_crop = False
+        self.image_size = meta['image_size']
+        self.z_dim = meta['z_dim']
+        self.c_dim = meta['c_dim']
+        self.lowres = meta['lowres']
+        self.lam = meta['lam']
+        self.lowres_size = self.image_size // self.lowres
+        self.image_shape = [self.image_size, self.image_size, self.c_dim]
+        self.lowres_shape = [self.lowres_size, self.lowres_size, self.c_dim]
+        self.ready_time = time.time()
+
+    def complete(self, config):
+        return complete_images(self, config)
+
+    def serve(self, config):
+        serve(Completer(self, config), config.serve, image_size=self.image_size,
+              is_crop=self.is_crop, window=config.batchWindow / 1000.)
+
+
+def comparison_inputs(config, meta, n):
+    # Up to `n` hole tiles from config.imgs in completion order, or random
+    # images with a centred hole covering config.centerScale of each side.
+    size = meta['image_size']
+    images, masks = [], []
+    for img in config.imgs:
+        image = get_image(img, size, is_crop=False)
+        holes = HoleIndex(image, size)
+        for maxX, maxY in spiral_tiles(image.shape, size):
+            mask = holes.mask((maxX, maxY))
+            if mask is not None and len(images) < n:
+                images.append(image[maxX - size:maxX, maxY - size:maxY, :])
+                masks.append(mask)
+    if not images:
+        rng = np.random.RandomState(0)
+        images = list(rng.uniform(-1, 1, size=(n, size, size, meta['c_dim'])))
+        mask = np.ones([size, size, meta['c_dim']])
+        lo, hi = int(size * (0.5 - config.centerScale / 2)), int(size * (0.5 + config.centerScale / 2))
+        mask[lo:hi, lo:hi, :] = 0.
+        masks = [mask] * n
+    return np.array(images, dtype=np.float32), np.array(masks)
+
+
+def compare_precision(path, config):
+    # Accuracy study for round_weights: runs config.nIter NumPy-Adam
+    # iterations of the completion loss from the same z on the same tiles
+    # with float32 weights and with weights rounded to config.precision, and
+    # reports how far the losses and the generated tiles drift apart along
+    # with iterations/sec for both. The rounded graph runs in float32, so the
+    # speed ratio is expected to stay close to 1.
+    with open(path + '.json') as f:
+        meta = json.load(f)
+    images, masks = comparison_inputs(config, meta, config.batchSize)
+    z0 = np.random.RandomState(0).uniform(-1, 1, size=(len(images), meta['z_dim']))
+
+    runs = {}
+    for precision in ['float32', config.precision]:
+        with tf.Graph().as_default(), tf.Session() as sess:
+            model = FrozenCompletionModel(sess, path, batch_size=len(images), precision=precision)
+            z = z0.copy()
+            adam = SlotAdam(z.shape, config.lr, config.beta1, config.beta2, config.eps)
+            fd = {model.images: images, model.mask: masks, model.lowres_mask: np.zeros(model.lowres_shape)}
+            fetches = [model.complete_loss, model.grad_complete_loss[0]]
+            # One untimed run so graph setup does not count against either side.
+            sess.run(fetches, feed_dict=dict(fd, **{model.z: z}))
+            losses = []
+            start = time.time()
+            for i in xrange(config.nIter):
+                loss, g = sess.run(fetches, feed_dict=dict(fd, **{model.z: z}))
+                losses.append(loss)
+                adam.step(z, g)
+            rate = config.nIter / max(time.time() - start, 1e-9)
+            runs[precision] = (np.array(losses), sess.run(model.G, feed_dict={model.z: z}), rate)
+
+    base, base_G, base_rate = runs['float32']
+    test, test_G, test_rate = runs[config.precision]
+    drift = np.abs(test - base) / np.maximum(np.abs(base), 1e-12)
+    stats = {
+        'precision': config.precision,
+        'tiles': len(images),
+        'iterations': config.nIter,
+        'float32_final_loss': float(base[-1].mean()),
+        'final_loss': float(test[-1].mean()),
+        'final_drift': float(drift[-1].mean()),
+        'max_drift': float(drift.max()),
+        'G_mean_abs_diff': float(np.abs(test_G - base_G).mean()),
+        'float32_iterations_per_sec': base_rate,
+        'iterations_per_sec': test_rate,
+        'speedup': test_rate / base_rate,
+    }
+    print("[Precision] {precision}-rounded weights vs float32 on {tiles:d} tiles, {iterations:d} iterations: "
+          "final loss {final_loss:.4f} vs {float32_final_loss:.4f} ({final_drift:.2%} drift, {max_drift:.2%} max), "
+          "generated tiles differ by {G_mean_abs_diff:.4f} on average, "
+          "{iterations_per_sec:.2f} vs {float32_iterations_per_sec:.2f} iterations/sec ({speedup:.2f}x)".format(**stats))
+    return stats
@@ -1,22 +1,20 @@
 from __future__ import division
 
-import itertools
 import os
 import time
-from glob import glob
 
 
 from six.moves import xrange
 
+from checkpoint import AsyncCheckpointer, restore as checkpoint_restore
+from completion import Completer, complete_images
+from dataset import PackedDataset, dataset_files, is_packed_dataset
 from ops import *
+from pipeline import BatchPrefetcher
+from profiler import PhaseTimer, StepTracer
+from server import serve
 from utils import *
-
-SUPPORTED_EXTENSIONS = ["png", "jpg", "jpeg"]
-
-
-def dataset_files(root):
-    return list(itertools.chain.from_iterable(
-        glob(os.path.join(root, "*.{}".format(ext))) for ext in SUPPORTED_EXTENSIONS))
+from writer import flush_images, save_images
 
 
 class DCGAN(object):
@@ -24,7 +22,7 @@ class DCGAN(object):
                  batch_size=64, sample_size=64, lowres=8,
                  z_dim=100, gf_dim=64, df_dim=64,
                  gfc_dim=1024, dfc_dim=1024, c_dim=3,
-                 checkpoint_dir=None, lam=0.1):
+                 checkpoint_dir=None, lam=0.1, inference=False):
 
         self.sess = sess
         self.is_crop = is_crop
@@ -46,6 +44,7 @@ class DCGAN(object):
         self.dfc_dim = dfc_dim
 
         self.lam = lam
+        self.inference = inference
 
         self.c_dim = c_dim
 
@@ -62,34 +61,26 @@ class DCGAN(object):
 
     def build_model(self):
         self.is_training = tf.placeholder(tf.bool, name='is_training')
+        # Inference graphs fix batch norm to its moving averages at build time,
+        # which keeps the moving-average updates out of the graph entirely.
+        self.bn_train = False if self.inference else self.is_training
         self.images = tf.placeholder(
             tf.float32, [None] + self.image_shape, name='real_images')
-        self.lowres_images = tf.reduce_mean(tf.reshape(self.images, [self.batch_size, self.lowres_size, self.lowres, self.lowres_size, self.lowres, self.c_dim]), [2, 4])
+        self.lowres_images = self.downsample(self.images)
         self.z = tf.placeholder(tf.float32, [None, self.z_dim], name='z')
-        self.z_sum = tf.summary.histogram("z", self.z)
 
         self.G = self.generator(self.z)
-        self.lowres_G = tf.reduce_mean(tf.reshape(self.G, [self.batch_size, self.lowres_size, self.lowres, self.lowres_size, self.lowres, self.c_dim]), [2, 4])
+        self.lowres_G = self.downsample(self.G)
         self.D, self.D_logits = self.discriminator(self.images)
 
         self.D_, self.D_logits_ = self.discriminator(self.G, reuse=True)
 
-        self.d_sum = tf.summary.histogram("d", self.D)
-        self.d__sum = tf.summary.histogram("d_", self.D_)
-        self.G_sum = tf.summary.image("G", self.G)
-
         self.d_loss_real = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(logits=self.D_logits, labels=tf.ones_like(self.D)))
         self.d_loss_fake = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(logits=self.D_logits_, labels=tf.zeros_like(self.D_)))
         self.g_loss = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(logits=self.D_logits_, labels=tf.ones_like(self.D_)))
 
-        self.d_loss_real_sum = tf.summary.scalar("d_loss_real", self.d_loss_real)
-        self.d_loss_fake_sum = tf.summary.scalar("d_loss_fake", self.d_loss_fake)
-
         self.d_loss = self.d_loss_real + self.d_loss_fake
 
-        self.g_loss_sum = tf.summary.scalar("g_loss", self.g_loss)
-        self.d_loss_sum = tf.summary.scalar("d_loss", self.d_loss)
-
         t_vars = tf.trainable_variables()
 
         self.d_vars = [var for var in t_vars if 'd_' in var.name]
@@ -97,123 +88,356 @@ class DCGAN(object):
 
         self.saver = tf.train.Saver(max_to_keep=1)
 
-        self.mask = tf.placeholder(tf.float32, self.image_shape, name='mask')
+        self.mask = tf.placeholder(tf.float32, [None] + self.image_shape, name='mask')
         self.lowres_mask = tf.placeholder(tf.float32, self.lowres_shape, name='lowres_mask')
-        self.contextual_loss = tf.reduce_sum(tf.contrib.layers.flatten(tf.abs(tf.multiply(self.mask, self.G) - tf.multiply(self.mask, self.images))), 1)
-        self.contextual_loss += tf.reduce_sum(tf.contrib.layers.flatten(tf.abs(tf.multiply(self.lowres_mask, self.lowres_G) - tf.multiply(self.lowres_mask, self.lowres_images))),1)
-        self.perceptual_loss = self.g_loss
+        self.contextual_loss = self.contextual(self.G, self.images, self.mask, self.lowres_mask)
+        self.perceptual_loss = self.perceptual(self.D_logits_)
         self.complete_loss = self.contextual_loss + self.lam * self.perceptual_loss
         self.grad_complete_loss = tf.gradients(self.complete_loss, self.z)
 
+    def downsample(self, x):
+        return tf.reduce_mean(tf.reshape(x, [-1, self.lowres_size, self.lowres, self.lowres_size, self.lowres, self.c_dim]), [2, 4])
+
+    def contextual(self, G, images, mask, lowres_mask):
+        loss = tf.reduce_sum(tf.contrib.layers.flatten(tf.abs(tf.multiply(mask, G) - tf.multiply(mask, images))), 1)
+        loss += tf.reduce_sum(tf.contrib.layers.flatten(tf.abs(tf.multiply(lowres_mask, self.downsample(G)) - tf.multiply(lowres_mask, self.downsample(images)))), 1)
+        return loss
+
+    def perceptual(self, D_logits_):
+        # Per slot, with the weight a single image had before completion was
+        # batched, so neither the slot count nor the batch size changes `lam`.
+        return tf.reduce_sum(tf.nn.sigmoid_cross_entropy_with_logits(logits=D_logits_, labels=tf.ones_like(D_logits_)), 1)
+
+    def latent_complete_loss(self, z, images, mask):
+        G = self.generator(z, reuse=True)
+        _, D_logits_ = self.discriminator(G, reuse=True)
+        return G, self.contextual(G, images, mask, self.latent_lowres_mask) + self.lam * self.perceptual(D_logits_)
+
+    def build_latent_optimizer(self, config):
+        # Completion state lives in the graph so that `latent_steps` Adam
+        # iterations on z run inside a single sess.run. These are local
+        # variables, so the Saver never sees them. The variables hold
+        # `batch_size` slots; each run only computes the rows in `latent_active`.
+        def local(name, shape):
+            return tf.Variable(tf.zeros(shape), trainable=False, name=name,
+                               collections=[tf.GraphKeys.LOCAL_VARIABLES])
+
+        with tf.variable_scope("latent"):
+            self.latent_z = local('z', [self.batch_size, self.z_dim])
+            self.latent_m = local('m', [self.batch_size, self.z_dim])
+            self.latent_v = local('v', [self.batch_size, self.z_dim])
+            self.latent_t = local('t', [self.batch_size, 1])
+            self.latent_images = local('images', [self.batch_size] + self.image_shape)
+            self.latent_mask = local('mask', [self.batch_size] + self.image_shape)
+            self.latent_lowres_mask = local('lowres_mask', self.lowres_shape)
+
+        # Restarts the slots listed in `latent_slots` from the fed z, images and masks.
+        self.latent_slots = tf.placeholder(tf.int32, [None], name='latent_slots')
+        self.latent_reset = tf.group(
+            tf.scatter_update(self.latent_z, self.latent_slots, self.z),
+            tf.scatter_update(self.latent_m, self.latent_slots, tf.zeros_like(self.z)),
+            tf.scatter_update(self.latent_v, self.latent_slots, tf.zeros_like(self.z)),
+            tf.scatter_update(self.latent_t, self.latent_slots, tf.zeros_like(self.z[:, :1])),
+            tf.scatter_update(self.latent_images, self.latent_slots, self.images),
+            tf.scatter_update(self.latent_mask, self.latent_slots, self.mask),
+            tf.assign(self.latent_lowres_mask, self.lowres_mask))
+
+        self.latent_active = tf.placeholder(tf.int32, [None], name='latent_active')
+        self.latent_steps = tf.placeholder(tf.int32, [], name='latent_steps')
+        images = tf.gather(self.latent_images, self.latent_active)
+        mask = tf.gather(self.latent_mask, self.latent_active)
+        n = tf.shape(self.latent_active)[:1]
+
+        def body(i, z, m, v, t, _, __):
+            _, loss = self.latent_complete_loss(z, images, mask)
+            g = tf.gradients(loss, z)[0]
+            g_norm = tf.sqrt(tf.reduce_sum(tf.square(g), 1))
+            t += 1
+            m = config.beta1 * m + (1 - config.beta1) * g
+            v = config.beta2 * v + (1 - config.beta2) * tf.multiply(g, g)
+            m_hat = m / (1 - tf.pow(config.beta1, t))
+            v_hat = v / (1 - tf.pow(config.beta2, t))
+            z = tf.clip_by_value(z - config.lr * m_hat / (tf.sqrt(v_hat) + config.eps), -1, 1)
+            return i + 1, z, m, v, t, loss, g_norm
+
+        loop = tf.while_loop(lambda i, *_: i < self.latent_steps, body,
+                             [tf.constant(0)] + [tf.gather(var, self.latent_active) for var in
+                                                 [self.latent_z, self.latent_m, self.latent_v, self.latent_t]] +
+                             [tf.zeros(n), tf.zeros(n)],
+                             back_prop=False)
+        _, z, m, v, t, self.latent_loss, self.latent_grad_norm = loop
+        self.latent_update = tf.group(
+            tf.scatter_update(self.latent_z, self.latent_active, z),
+            tf.scatter_update(self.latent_m, self.latent_active, m),
+            tf.scatter_update(self.latent_v, self.latent_active, v),
+            tf.scatter_update(self.latent_t, self.latent_active, t))
+
+        self.latent_G, self.latent_G_loss = self.latent_complete_loss(
+            tf.gather(self.latent_z, self.latent_active), images, mask)
+
+    def build_hmc_sampler(self, config):
+        # One HMC transition per sess.run: `hmcL` leapfrog steps for every
+        # active slot inside a tf.while_loop, then a per-slot Metropolis
+        # accept/reject. Each slot anneals its own beta by `hmcAnneal` after
+        # every transition.
+        with tf.variable_scope("latent"):
+            self.hmc_beta = tf.Variable(tf.zeros([self.batch_size]), trainable=False, name='hmc_beta',
+                                        collections=[tf.GraphKeys.LOCAL_VARIABLES])
+            self.hmc_accepts = tf.Variable(tf.zeros([self.batch_size]), trainable=False, name='hmc_accepts',
+                                           collections=[tf.GraphKeys.LOCAL_VARIABLES])
+
+        self.hmc_reset = tf.group(
+            tf.scatter_update(self.hmc_beta, self.latent_slots, tf.fill(tf.shape(self.latent_slots), float(config.hmcBeta))),
+            tf.scatter_update(self.hmc_accepts, self.latent_slots, tf.zeros(tf.shape(self.latent_slots))))
+
+        active = self.latent_active
+        images = tf.gather(self.latent_images, active)
+        mask = tf.gather(self.latent_mask, active)
+        hmc_beta = tf.gather(self.hmc_beta, active)
+        beta = hmc_beta[:, None]
+        z0 = tf.gather(self.latent_z, active)
+        _, loss0 = self.latent_complete_loss(z0, images, mask)
+        g0 = tf.gradients(loss0, z0)[0]
+        p0 = tf.random_normal(tf.shape(z0))
+
+        def leapfrog(j, z, p, g, _):
+            p = p - config.hmcEps / 2 * beta * g
+            # Reflect off the walls of [-1, 1] and flip the momentum there; unlike
+            # clipping this keeps the step reversible (for moves shorter than 2).
+            z = z + config.hmcEps * p
+            p = tf.where(tf.abs(z) > 1, -p, p)
+            z = tf.where(z > 1, 2 - z, tf.where(z < -1, -2 - z, z))
+            _, loss = self.latent_complete_loss(z, images, mask)
+            g = tf.gradients(loss, z)[0]
+            p = p - config.hmcEps / 2 * beta * g
+            return j + 1, z, p, g, loss
+
+        _, z, p, g, loss = tf.while_loop(lambda j, *_: j < config.hmcL, leapfrog,
+                                         [tf.constant(0), z0, p0, g0, loss0], back_prop=False)
+
+        logprob_old = hmc_beta * loss0 + tf.reduce_sum(tf.square(p0), 1) / 2
+        logprob = hmc_beta * loss + tf.reduce_sum(tf.square(p), 1) / 2
+        accept = tf.random_uniform(tf.shape(loss)) < tf.exp(logprob_old - logprob)
+
+        self.hmc_loss = tf.where(accept, loss, loss0)
+        self.hmc_grad_norm = tf.sqrt(tf.reduce_sum(tf.square(tf.where(accept, g, g0)), 1))
+        update = [
+            tf.scatter_update(self.latent_z, active, tf.where(accept, z, z0)),
+            tf.scatter_add(self.hmc_accepts, active, tf.cast(accept, tf.float32)),
+            tf.scatter_update(self.hmc_beta, active, hmc_beta * config.hmcAnneal)]
+        self.hmc_update = tf.group(*update)
+        # Accept counts and betas as of after this transition.
+        with tf.control_dependencies(update):
+            self.hmc_accepts_after = self.hmc_accepts.read_value()
+            self.hmc_beta_after = self.hmc_beta.read_value()
+
+    def build_towers(self, config):
+        # Data-parallel training step: every batch is split into
+        # config.num_towers shards, each shard runs its own generator and
+        # discriminator replica over the shared variables (batch norm
+        # statistics are per shard), and the D and G gradients are averaged
+        # before a single Adam update. Returns the two update ops, D, D_ and G
+        # gathered from the shards, and the shard-averaged d_loss_fake,
+        # d_loss_real and g_loss.
+        n = config.num_towers
+        assert self.batch_size % n == 0, "batch_size must be divisible by num_towers"
+        d_opt = tf.train.AdamOptimizer(config.learning_rate, beta1=config.beta1)
+        g_opt = tf.train.AdamOptimizer(config.learning_rate, beta1=config.beta1)
+
+        d_grads, g_grads, outputs, losses = [], [], [], []
+        for i, (images, z) in enumerate(zip(tf.split(self.images, n), tf.split(self.z, n))):
+            with tf.name_scope('tower_{}'.format(i)):
+                G = self.generator(z, reuse=True)
+                D, D_logits = self.discriminator(images, reuse=True)
+                D_, D_logits_ = self.discriminator(G, reuse=True)
+                d_loss_real = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(logits=D_logits, labels=tf.ones_like(D_logits)))
+                d_loss_fake = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(logits=D_logits_, labels=tf.zeros_like(D_logits_)))
+                g_loss = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(logits=D_logits_, labels=tf.ones_like(D_logits_)))
+                d_grads.append(d_opt.compute_gradients(d_loss_real + d_loss_fake, var_list=self.d_vars))
+                g_grads.append(g_opt.compute_gradients(g_loss, var_list=self.g_vars))
+                outputs.append([D, D_, G])
+                losses.append([d_loss_fake, d_loss_real, g_loss])
+
+        def average(tower_grads):
+            return [(tf.add_n([g for g, _ in grads]) / n, grads[0][1]) for grads in zip(*tower_grads)]
+
+        d_optim = d_opt.apply_gradients(average(d_grads))
+        g_optim = g_opt.apply_gradients(average(g_grads))
+        return [d_optim, g_optim] + [tf.concat(list(t), 0) for t in zip(*outputs)] + \
+               [tf.add_n(list(l)) / n for l in zip(*losses)]
+
+    def build_summaries(self, D, D_, G, d_loss_real, d_loss_fake, g_loss):
+        self.z_sum = tf.summary.histogram("z", self.z)
+        self.d_sum = tf.summary.histogram("d", D)
+        self.d__sum = tf.summary.histogram("d_", D_)
+        self.G_sum = tf.summary.image("G", G)
+        self.d_loss_real_sum = tf.summary.scalar("d_loss_real", d_loss_real)
+        self.d_loss_fake_sum = tf.summary.scalar("d_loss_fake", d_loss_fake)
+        self.g_loss_sum = tf.summary.scalar("g_loss", g_loss)
+        self.d_loss_sum = tf.summary.scalar("d_loss", d_loss_real + d_loss_fake)
+
+        self.g_sum = tf.summary.merge([self.z_sum, self.d__sum, self.G_sum, self.d_loss_fake_sum, self.g_loss_sum])
+        self.d_sum = tf.summary.merge([self.z_sum, self.d_sum, self.d_loss_real_sum, self.d_loss_sum])
+        self.all_sum = tf.summary.merge([self.g_sum, self.d_sum])
+
     def train(self, config):
-        data = dataset_files(config.dataset)
-        """"
-        data = list()
-
-        for i in tmp_data:
-            image = get_image(i, self.image_size, is_crop=self.is_crop)
-            #       #image = scipy.misc.imread(i, mode='RGB').astype(np.float)
-            for x in xrange(0, image.shape[0], 64):
-                for y in xrange(0, image.shape[1], 64):
-                    mxX = min(x + 64, image.shape[0])
-                    mxY = min(y + 64, image.shape[1])
-                    isGood = True
-                    for tx in xrange(mxX - 64, mxX):
-                        for ty in xrange(mxY - 64, mxY):
-                            def almost_equal(a, b, epsilon=0.7):
-                                return abs(a - b) <= epsilon
-
-                            if almost_equal(image[tx, ty, 0], 1) and almost_equal(image[tx, ty, 1], -1) and almost_equal(image[tx, ty, 2], 1):
-                                isGood = False
-                    if isGood:
-                        imgName = 'train/tmp{:s}.png'.format(str(i.__hash__()) + str(x) + str(y))
-                        save_images(np.array([image[mxX - 64: mxX, mxY - 64: mxY, :]]).astype(np.float32), [1, 1], imgName)
-                        data.append(imgName)
-        """
+        packed = PackedDataset(config.dataset) if is_packed_dataset(config.dataset) else None
+        assert packed is None or packed.image_size == self.image_size, \
+            "packed dataset holds {0}x{0} images, model expects {1}x{1}".format(
+                packed.image_size, self.image_size)
+        data = dataset_files(config.dataset) if packed is None else []
         np.random.shuffle(data)
-        assert (len(data) > 0)
+        n_data = len(packed) if packed is not None else len(data)
+        assert (n_data > 0)
 
-        d_optim = tf.train.AdamOptimizer(config.learning_rate, beta1=config.beta1).minimize(self.d_loss, var_list=self.d_vars)
-        g_optim = tf.train.AdamOptimizer(config.learning_rate, beta1=config.beta1).minimize(self.g_loss, var_list=self.g_vars)
+        if config.num_towers > 1:
+            d_optim, g_optim, D, D_, G, d_loss_fake, d_loss_real, g_loss = self.build_towers(config)
+        else:
+            d_optim = tf.train.AdamOptimizer(config.learning_rate, beta1=config.beta1).minimize(self.d_loss, var_list=self.d_vars)
+            g_optim = tf.train.AdamOptimizer(config.learning_rate, beta1=config.beta1).minimize(self.g_loss, var_list=self.g_vars)
+            D, D_, G = self.D, self.D_, self.G
+            d_loss_fake, d_loss_real, g_loss = self.d_loss_fake, self.d_loss_real, self.g_loss
         try:
             tf.global_variables_initializer().run()
         except:
             tf.initialize_all_variables().run()
+        # Weights plus optimizer slots, so a resumed run continues the same Adam trajectory.
+        train_vars = tf.global_variables()
+        checkpointer = AsyncCheckpointer(self.sess, train_vars, config.checkpoint_dir, self.model_name,
+                                         max_to_keep=config.checkpoint_keep,
+                                         keep_every_hours=config.checkpoint_keep_hours)
 
-        self.g_sum = tf.summary.merge([self.z_sum, self.d__sum, self.G_sum, self.d_loss_fake_sum, self.g_loss_sum])
-        self.d_sum = tf.summary.merge([self.z_sum, self.d_sum, self.d_loss_real_sum, self.d_loss_sum])
+        self.build_summaries(D, D_, G, d_loss_real, d_loss_fake, g_loss)
         self.writer = tf.summary.FileWriter("./logs", self.sess.graph)
 
         sample_z = np.random.uniform(-1, 1, size=(self.sample_size, self.z_dim))
-        sample_files = data[0:self.sample_size]
-
-        sample = [get_image(sample_file, self.image_size, is_crop=self.is_crop) for sample_file in sample_files]
-        sample_images = np.array(sample).astype(np.float32)
+        if packed is not None:
+            sample_images = packed.batch(np.arange(min(self.sample_size, n_data)))
+        else:
+            sample_files = data[0:self.sample_size]
+            sample = [get_image(sample_file, self.image_size, is_crop=self.is_crop) for sample_file in sample_files]
+            sample_images = np.array(sample).astype(np.float32)
 
         counter = 1
+        start_epoch, start_idx, order = 0, 0, None
         start_time = time.time()
 
-        if self.load(self.checkpoint_dir):
+        timer = PhaseTimer(config.profile_window)
+        tracer = StepTracer(config.trace_dir, config.trace_start, config.trace_steps)
+
+        def run(phase, fetches, feed_dict):
+            with timer.phase(phase):
+                return tracer.run(self.sess, fetches, feed_dict, counter, phase)
+
+        def training_state(epoch, next_idx):
+            return {'counter': counter, 'epoch': epoch, 'idx': next_idx, 'order': order,
+                    'data': data if packed is None else None, 'sample_z': sample_z, 'rng': np.random.get_state()}
+
+        path, state = checkpoint_restore(self.sess, config.checkpoint_dir, train_vars)
+        if state is not None:
+            counter, start_epoch, start_idx, order = state['counter'], state['epoch'], state['idx'], state['order']
+            if state['data'] is not None:
+                data = state['data']
+            sample_z = state['sample_z']
+            np.random.set_state(state['rng'])
+            print("resuming from {} at epoch {:d}, batch {:d}".format(path, start_epoch, start_idx))
+        elif path is not None:
             print("model in the checkpoint")
         else:
             print("new model")
 
-        for epoch in xrange(config.epoch):
+        for epoch in xrange(start_epoch, config.epoch):
            # data = dataset_files(config.dataset)
 
-            batch_idxs = min(len(data), config.train_size) // self.batch_size
+            batch_idxs = int(min(n_data, config.train_size) // self.batch_size)
+            # A resumed epoch keeps its saved order and skips the batches already trained on.
+            start = start_idx if epoch == start_epoch else 0
+            if start == 0 or order is None:
+                order = np.random.permutation(n_data) if packed is not None else None
 
-            for idx in xrange(0, batch_idxs):
+            def load_batch(idx):
+                if packed is not None:
+                    return packed.batch(order[idx * config.batch_size:(idx + 1) * config.batch_size])
                 batch_files = data[idx * config.batch_size:(idx + 1) * config.batch_size]
                 batch = [get_image(batch_file, self.image_size, is_crop=self.is_crop)
                          for batch_file in batch_files]
-                batch_images = np.array(batch).astype(np.float32)
-
-                batch_z = np.random.uniform(-1, 1, [config.batch_size, self.z_dim]).astype(np.float32)
+                return np.array(batch).astype(np.float32)
 
-                # Update D network
-                _, summary_str = self.sess.run([d_optim, self.d_sum],
-                                               feed_dict={self.images: batch_images, self.z: batch_z,
-                                                          self.is_training: True})
-                self.writer.add_summary(summary_str, counter)
+            loader = BatchPrefetcher(lambda idx: load_batch(start + idx), batch_idxs - start,
+                                     num_workers=config.loader_workers, queue_depth=config.prefetch_batches)
 
-                # Update G network
-                _, summary_str = self.sess.run([g_optim, self.g_sum], feed_dict={self.z: batch_z, self.is_training: True})
-                self.writer.add_summary(summary_str, counter)
-
-                # Run g_optim twice to make sure that d_loss does not go to zero (different from paper)
-                _, summary_str = self.sess.run([g_optim, self.g_sum], feed_dict={self.z: batch_z, self.is_training: True})
-                self.writer.add_summary(summary_str, counter)
+            waited = 0.0
+            for idx, batch_images in enumerate(loader, start):
+                timer.start_step(counter)
+                timer.add('load', loader.wait_time - waited)
+                waited = loader.wait_time
+                batch_z = np.random.uniform(-1, 1, [config.batch_size, self.z_dim]).astype(np.float32)
 
-                errD_fake = self.d_loss_fake.eval({self.z: batch_z, self.is_training: False})
-                errD_real = self.d_loss_real.eval({self.images: batch_images, self.is_training: False})
-                errG = self.g_loss.eval({self.z: batch_z, self.is_training: False})
+                if config.exact_logging:
+                    # Update D network
+                    _, summary_str = run('d_update', [d_optim, self.d_sum],
+                                         {self.images: batch_images, self.z: batch_z, self.is_training: True})
+                    with timer.phase('summary'):
+                        self.writer.add_summary(summary_str, counter)
+
+                    # Update G network
+                    _, summary_str = run('g_update', [g_optim, self.g_sum], {self.z: batch_z, self.is_training: True})
+                    with timer.phase('summary'):
+                        self.writer.add_summary(summary_str, counter)
+
+                    # Run g_optim twice to make sure that d_loss does not go to zero (different from paper)
+                    _, summary_str = run('g_update2', [g_optim, self.g_sum], {self.z: batch_z, self.is_training: True})
+                    with timer.phase('summary'):
+                        self.writer.add_summary(summary_str, counter)
+
+                    errD_fake = run('loss_eval', d_loss_fake, {self.z: batch_z, self.is_training: False})
+                    errD_real = run('loss_eval', d_loss_real, {self.images: batch_images, self.is_training: False})
+                    errG = run('loss_eval', g_loss, {self.z: batch_z, self.is_training: False})
+                else:
+                    # Losses come from the optimizer runs themselves, i.e. they are
+                    # measured just before each update rather than after the step.
+                    summarize = np.mod(counter, config.summary_interval) == 0
+                    fetches = [d_optim, d_loss_fake, d_loss_real] + ([self.all_sum] if summarize else [])
+                    out = run('d_update', fetches, {self.images: batch_images, self.z: batch_z, self.is_training: True})
+                    errD_fake, errD_real = out[1], out[2]
+                    if summarize:
+                        with timer.phase('summary'):
+                            self.writer.add_summary(out[3], counter)
+
+                    run('g_update', g_optim, {self.z: batch_z, self.is_training: True})
+                    # Run g_optim twice to make sure that d_loss does not go to zero (different from paper)
+                    _, errG = run('g_update2', [g_optim, g_loss], {self.z: batch_z, self.is_training: True})
 
                 counter += 1
-                print("Epoch: [{:2d}] [{:4d}/{:4d}] time: {:4.4f}, d_loss: {:.8f}, g_loss: {:.8f}".format(
-                    epoch, idx, batch_idxs, time.time() - start_time, errD_fake + errD_real, errG))
+                print("Epoch: [{:2d}] [{:4d}/{:4d}] time: {:4.4f}, input wait: {:4.4f}, d_loss: {:.8f}, g_loss: {:.8f}".format(
+                    epoch, idx, batch_idxs, time.time() - start_time, loader.wait_time, errD_fake + errD_real, errG))
 
                 if np.mod(counter, 100) == 1:
-                    samples, d_loss, g_loss = self.sess.run(
-                        [self.G, self.d_loss, self.g_loss],
-                        feed_dict={self.z: sample_z, self.images: sample_images, self.is_training: False}
-                    )
-                    save_images(samples, [8, 8], './samples/train_{:02d}_{:04d}.png'.format(epoch, idx))
+                    with timer.phase('sample'):
+                        samples, d_loss, g_loss = self.sess.run(
+                            [self.G, self.d_loss, self.g_loss],
+                            feed_dict={self.z: sample_z, self.images: sample_images, self.is_training: False}
+                        )
+                        save_images(samples, [8, 8], './samples/train_{:02d}_{:04d}.png'.format(epoch, idx))
                     print("[Sample] d_loss: {:.8f}, g_loss: {:.8f}".format(d_loss, g_loss))
 
-                if np.mod(counter, 500) == 2:
-                    self.save(config.checkpoint_dir, counter)
+                if np.mod(counter, config.checkpoint_interval) == 2 % config.checkpoint_interval:
+                    # Only the snapshot copy is timed here; the write runs in the background.
+                    with timer.phase('checkpoint'):
+                        checkpointer.save(counter, training_state(epoch, idx + 1))
 
-    def complete(self, config):
-        def make_dir(name):
-            p = os.path.join(config.outDir, name)
-            if not os.path.exists(p):
-                os.makedirs(p)
+                if config.profile_interval > 0 and np.mod(counter, config.profile_interval) == 0:
+                    print("[Profile] step {:d}\n{}".format(counter, timer.report()))
 
-        make_dir('hats_imgs')
-        make_dir('completed')
-        make_dir('logs')
+            print("[Input] epoch {:2d}: starved on {:d}/{:d} batches, {:.4f}s waiting for data".format(
+                epoch, loader.starved, batch_idxs, loader.wait_time))
 
+        if counter > 1:
+            checkpointer.save(counter, training_state(config.epoch, 0))
+        checkpointer.wait()
+        flush_images()
+
+    def prepare_completion(self, config):
         try:
             tf.global_variables_initializer().run()
         except:
@@ -222,149 +446,21 @@ class DCGAN(object):
         isLoaded = self.load(self.checkpoint_dir)
         assert isLoaded
 
-        nImgs = len(config.imgs)
-
-        batch_idxs = int(np.ceil(nImgs / self.batch_size))
-        lowres_mask = np.zeros(self.lowres_shape)
-
-        for idx in xrange(0, batch_idxs):
-            l = idx * self.batch_size
-            u = min((idx + 1) * self.batch_size, nImgs)
-            batchSz = u - l
-            batch_files = config.imgs[l:u]
-
-            batch0 = [get_image(batch_file, self.image_size, is_crop=self.is_crop) for batch_file in batch_files]
-
-            a = 0
-            b = 0
-            queue1 = list()
-            queue2 = list()
-            queue3 = list()
-            queue4 = list()
-            step = 50
-            n = batch0[0].shape[0]
-            m = batch0[0].shape[1]
-
-            while a <= m and b <= m:
-                def func(x, y, q):
-                    mxX = min(x + 64, batch0[0].shape[0])
-                    mxY = min(y + 64, batch0[0].shape[1])
-                    if len(q) == 0 or q[-1] != (mxX, mxY):
-                        q.append((mxX, mxY))
-                    return mxX, mxY
-
-                for k in xrange(a, n, step):
-                    func(k, b, queue1)
-                for k in xrange(b + step, m, step):
-                    func(n, k, queue2)
-                for k in xrange(n - step, a, -step):
-                    func(k, n, queue3)
-                for k in xrange(m - step, b + step, -step):
-                    func(a, k, queue4)
-
-                a += step
-                b += step
-                n -= step
-                m -= step
-
-            queue1.reverse()
-            queue2.reverse()
-            queue3.reverse()
-            queue4.reverse()
-
-            for q in [queue1, queue2, queue3, queue4]:
-                for cnt in q:
-                    maxX, maxY = cnt
-
-                    batch = [(batch0[0][maxX - 64: maxX, maxY - 64:maxY, :])]
-                    isNeededToReconstuct = False
-
-                    mask = np.ones(self.image_shape)
-                    for i in range(0, self.image_size):
-                        for j in range(0, self.image_size):
-                            def almost_equal(x, y, epsilon=0.7):
-                                return abs(x - y) <= epsilon
-                            if almost_equal(batch[0][i][j][0], 1.0) and almost_equal(batch[0][i][j][1], -1.0) and almost_equal(batch[0][i][j][2], 1.0):
-                                mask[i, j, :] = 0.0
-                                isNeededToReconstuct = True
-
-                    if not isNeededToReconstuct:
-                        continue
-
-                    batch_images = np.array(batch).astype(np.float32)
-                    if batchSz < self.batch_size:
-                        print(batchSz)
-                        padSz = ((0, int(self.batch_size - batchSz)), (0, 0), (0, 0), (0, 0))
-                        batch_images = np.pad(batch_images, padSz, 'constant')
-                        batch_images = batch_images.astype(np.float32)
-
-                    zhats = np.random.uniform(-1, 1, size=(self.batch_size, self.z_dim))
-                    m = 0
-                    v = 0
-
-                    nRows = np.ceil(batchSz / 8)
-                    nCols = min(8, batchSz)
-                    save_images(batch_images[:batchSz, :, :, :], [nRows, nCols], os.path.join(config.outDir, 'before.png'))
-                    masked_images = np.multiply(batch_images, mask)
-                    # masked_images = batch_images
-                    save_images(masked_images[:batchSz, :, :, :], [nRows, nCols], os.path.join(config.outDir, 'masked.png'))
-
-                    if lowres_mask.any():
-                        lowres_images = np.reshape(batch_images,
-                                                   [self.batch_size, self.lowres_size, self.lowres, self.lowres_size,
-                                                    self.lowres, self.c_dim]).mean(4).mean(2)
-                        lowres_images = np.multiply(lowres_images, lowres_mask)
-                        lowres_images = np.repeat(np.repeat(lowres_images, self.lowres, 1), self.lowres, 2)
-                        save_images(lowres_images[:batchSz, :, :, :], [nRows, nCols], os.path.join(config.outDir, 'lowres.png'))
-
-                    for img in range(batchSz):
-                        with open(os.path.join(config.outDir, 'logs/hats_{:02d}.log'.format(img)), 'a') as f:
-                            f.write('iter loss ' + ' '.join(['z{}'.format(zi) for zi in range(self.z_dim)]) + '\n')
-
-                    loss = 0
-                    for i in xrange(config.nIter):
-                        fd = {
-                            self.z: zhats,
-                            self.mask: mask,
-                            self.lowres_mask: lowres_mask,
-                            self.images: batch_images,
-                            self.is_training: False
-                        }
-                        run = [self.complete_loss, self.grad_complete_loss, self.G, self.lowres_G]
-                        loss, g, G_imgs, lowres_G_imgs = self.sess.run(run, feed_dict=fd)
-
-                        for img in range(batchSz):
-                            with open(os.path.join(config.outDir, 'logs/hats_{:02d}.log'.format(img)), 'ab') as f:
-                                f.write('{} {} '.format(i, loss[img]).encode())
-                                np.savetxt(f, zhats[img:img + 1])
-
-                        if i % config.outInterval == 0:
-                            print(i, np.mean(loss[0:batchSz]))
-                            inv_masked_hat_images = np.multiply(G_imgs, 1.0 - mask)
-                            completed = masked_images + inv_masked_hat_images
-
-                            for i0 in range(maxX - 64, maxX):
-                                for j0 in range(maxY - 64, maxY):
-                                    batch0[0][i0][j0] = completed[0][i0 - maxX + 64][j0 - maxY + 64]
-
-                            imgName = os.path.join(config.outDir, 'completed/{:04d}.png'.format(i))
-                            save_images(completed[:batchSz, :, :, :], [nRows, nCols], imgName)
-
-                        # Optimize single completion with Adam
-                        m_prev = np.copy(m)
-                        v_prev = np.copy(v)
-                        m = config.beta1 * m_prev + (1 - config.beta1) * g[0]
-                        v = config.beta2 * v_prev + (1 - config.beta2) * np.multiply(g[0], g[0])
-                        m_hat = m / (1 - config.beta1 ** (i + 1))
-                        v_hat = v / (1 - config.beta2 ** (i + 1))
-                        zhats += - np.true_divide(config.lr * m_hat, (np.sqrt(v_hat) + config.eps))
-                        zhats = np.clip(zhats, -1, 1)
-
-                    if loss > 700:
-                        break
-
-            imgName = os.path.join(config.outDir, 'completed/finale.png')
-            save_images(np.array(batch0).astype(np.float32), [1, 1], imgName)
+        if config.method in ('graph-adam', 'hmc'):
+            self.build_latent_optimizer(config)
+            if config.method == 'hmc':
+                self.build_hmc_sampler(config)
+            tf.variables_initializer(tf.local_variables(scope="latent")).run()
+        self.ready_time = time.time()
+
+    def complete(self, config):
+        self.prepare_completion(config)
+        return complete_images(self, config)
+
+    def serve(self, config):
+        self.prepare_completion(config)
+        serve(Completer(self, config), config.serve, image_size=self.image_size,
+              is_crop=self.is_crop, window=config.batchWindow / 1000.)
 
     def discriminator(self, image, reuse=False):
         with tf.variable_scope("discriminator") as scope:
@@ -372,20 +468,26 @@ class DCGAN(object):
                 scope.reuse_variables()
 
             h0 = lrelu(conv2d(image, self.df_dim, name='d_h0_conv'))
-            h1 = lrelu(self.d_bns[0](conv2d(h0, self.df_dim * 2, name='d_h1_conv'), self.is_training))
-            h2 = lrelu(self.d_bns[1](conv2d(h1, self.df_dim * 4, name='d_h2_conv'), self.is_training))
-            h3 = lrelu(self.d_bns[2](conv2d(h2, self.df_dim * 8, name='d_h3_conv'), self.is_training))
+            h1 = lrelu(self.d_bns[0](conv2d(h0, self.df_dim * 2, name='d_h1_conv'), self.bn_train))
+            h2 = lrelu(self.d_bns[1](conv2d(h1, self.df_dim * 4, name='d_h2_conv'), self.bn_train))
+            h3 = lrelu(self.d_bns[2](conv2d(h2, self.df_dim * 8, name='d_h3_conv'), self.bn_train))
             h4 = linear(tf.reshape(h3, [-1, 8192]), 1, 'd_h4_lin')
 
             return tf.nn.sigmoid(h4), h4
 
-    def generator(self, z):
+    def generator(self, z, reuse=False):
         with tf.variable_scope("generator") as scope:
-            self.z_, self.h0_w, self.h0_b = linear(z, self.gf_dim * 8 * 4 * 4, 'g_h0_lin', with_w=True)
+            if reuse:
+                scope.reuse_variables()
+
+            z_, h0_w, h0_b = linear(z, self.gf_dim * 8 * 4 * 4, 'g_h0_lin', with_w=True)
+            if not reuse:
+                self.z_, self.h0_w, self.h0_b = z_, h0_w, h0_b
 
+            batch_size = tf.shape(z)[0]
             hs = [None]
-            hs[0] = tf.reshape(self.z_, [-1, 4, 4, self.gf_dim * 8])
-            hs[0] = tf.nn.relu(self.g_bns[0](hs[0], self.is_training))
+            hs[0] = tf.reshape(z_, [-1, 4, 4, self.gf_dim * 8])
+            hs[0] = tf.nn.relu(self.g_bns[0](hs[0], self.bn_train))
 
             i = 1
             depth_mul = 8
@@ -394,8 +496,8 @@ class DCGAN(object):
             while size < self.image_size:
                 hs.append(None)
                 name = 'g_h{}'.format(i)
-                hs[i], _, _ = conv2d_transpose(hs[i - 1], [self.batch_size, size, size, self.gf_dim * depth_mul], name=name, with_w=True)
-                hs[i] = tf.nn.relu(self.g_bns[i](hs[i], self.is_training))
+                hs[i], _, _ = conv2d_transpose(hs[i - 1], [batch_size, size, size, self.gf_dim * depth_mul], name=name, with_w=True)
+                hs[i] = tf.nn.relu(self.g_bns[i](hs[i], self.bn_train))
 
                 i += 1
                 depth_mul //= 2
@@ -403,7 +505,7 @@ class DCGAN(object):
 
             hs.append(None)
             name = 'g_h{}'.format(i)
-            hs[i], _, _ = conv2d_transpose(hs[i - 1], [self.batch_size, size, size, 3], name=name, with_w=True)
+            hs[i], _, _ = conv2d_transpose(hs[i - 1], [batch_size, size, size, 3], name=name, with_w=True)
 
             return tf.nn.tanh(hs[i])
 
@@ -45,11 +45,14 @@ def conv2d_transpose(input_, output_shape, k_h=5, k_w=5, d_h=2, d_w=2, stddev=0.
     with tf.variable_scope(name):
         w = tf.get_variable('w', [k_h, k_w, output_shape[-1], input_.get_shape()[-1]], initializer=tf.random_normal_initializer(stddev=stddev))
 
+        # The batch entry of output_shape may be a tensor, e.g. tf.shape(z)[0].
+        static_shape = [d if isinstance(d, int) else None for d in output_shape]
         try:
-            deconv = tf.nn.conv2d_transpose(input_, w, output_shape=output_shape, strides=[1, d_h, d_w, 1])
+            deconv = tf.nn.conv2d_transpose(input_, w, output_shape=tf.stack(output_shape), strides=[1, d_h, d_w, 1])
 
         except AttributeError:
-            deconv = tf.nn.deconv2d(input_, w, output_shape=output_shape, strides=[1, d_h, d_w, 1])
+            deconv = tf.nn.deconv2d(input_, w, output_shape=tf.stack(output_shape), strides=[1, d_h, d_w, 1])
+        deconv.set_shape(static_shape)
 
         biases = tf.get_variable('biases', [output_shape[-1]], initializer=tf.constant_initializer(0.0))
         # deconv = tf.reshape(tf.nn.bias_add(deconv, biases), deconv.get_shape())
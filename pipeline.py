@@ -0,0 +1,78 @@
+from __future__ import division
+
+import threading
+import time
+
+from six.moves import xrange
+
+
+# Decodes batches on worker threads and yields them in order. At most
+# `queue_depth` decoded batches are held at once; time the consumer spends
+# blocked on an empty queue is accumulated in `wait_time`.
+class BatchPrefetcher(object):
+    def __init__(self, load_batch, n_batches, num_workers=4, queue_depth=8):
+        self.load_batch = load_batch
+        self.n_batches = n_batches
+        self.num_workers = max(1, num_workers)
+        self.queue_depth = max(1, queue_depth)
+
+        self.wait_time = 0.0
+        self.starved = 0
+
+        self._next_task = 0
+        self._results = {}
+        self._error = None
+        self._closed = False
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._slots = threading.Semaphore(self.queue_depth)
+
+        self._workers = [threading.Thread(target=self._work) for _ in xrange(self.num_workers)]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+
+    def _work(self):
+        while True:
+            self._slots.acquire()
+            with self._lock:
+                if self._closed or self._error is not None or self._next_task >= self.n_batches:
+                    self._slots.release()
+                    return
+                idx = self._next_task
+                self._next_task += 1
+            try:
+                batch = self.load_batch(idx)
+            except Exception as e:
+                with self._lock:
+                    self._error = e
+                    self._ready.notify_all()
+                return
+            with self._lock:
+                self._results[idx] = batch
+                self._ready.notify_all()
+
+    def __iter__(self):
+        try:
+            for idx in xrange(self.n_batches):
+                with self._lock:
+                    if idx not in self._results and self._error is None:
+                        self.starved += 1
+                        start = time.time()
+                        while idx not in self._results and self._error is None:
+                            self._ready.wait()
+                        self.wait_time += time.time() - start
+                    if self._error is not None:
+                        raise self._error
+                    batch = self._results.pop(idx)
+                self._slots.release()
+                yield batch
+        finally:
+            self.close()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._results.clear()
+        for _ in self._workers:
+            self._slots.release()
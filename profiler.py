@@ -0,0 +1,82 @@
+from __future__ import division
+
+import collections
+import contextlib
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+
+# Wall-clock time per named phase over the last `window` steps. Phases may
+# run several times a step or only every N steps, so shares come from each
+# phase's mean time per step over the same window of steps.
+class PhaseTimer(object):
+    def __init__(self, window=100):
+        self.window = window
+        self.step = 0
+        self.first_step = None
+        self.samples = collections.OrderedDict()
+
+    def start_step(self, step):
+        self.step = step
+        if self.first_step is None:
+            self.first_step = step
+        for s in self.samples.values():
+            while s and s[0][0] <= step - self.window:
+                s.popleft()
+
+    def add(self, name, seconds):
+        if name not in self.samples:
+            self.samples[name] = collections.deque()
+        self.samples[name].append((self.step, seconds))
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def report(self):
+        steps = max(min(self.window, self.step - (self.first_step or 0) + 1), 1)
+        per_step = dict((name, sum(t for _, t in s) / steps) for name, s in self.samples.items())
+        total = max(sum(per_step.values()), 1e-9)
+        lines = ["{:>12s} {:>6s} {:>10s} {:>10s} {:>10s} {:>7s}".format(
+            'phase', 'n', 'p50 ms', 'p95 ms', 'ms/step', 'share')]
+        for name, s in self.samples.items():
+            if not s:
+                continue
+            p50, p95 = np.percentile([t for _, t in s], [50, 95]) * 1000
+            lines.append("{:>12s} {:6d} {:10.2f} {:10.2f} {:10.2f} {:6.1%}".format(
+                name, len(s), p50, p95, per_step[name] * 1000, per_step[name] / total))
+        return '\n'.join(lines)
+
+
+# Captures a Chrome trace of every sess.run issued during steps
+# [start, start + steps), one file per run.
+class StepTracer(object):
+    def __init__(self, trace_dir, start, steps):
+        self.trace_dir = trace_dir
+        self.start = start
+        self.steps = steps
+
+    def active(self, step):
+        return self.steps > 0 and self.start <= step < self.start + self.steps
+
+    def run(self, sess, fetches, feed_dict, step, name):
+        if not self.active(step):
+            return sess.run(fetches, feed_dict=feed_dict)
+
+        if not os.path.exists(self.trace_dir):
+            os.makedirs(self.trace_dir)
+        options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+        metadata = tf.RunMetadata()
+        out = sess.run(fetches, feed_dict=feed_dict, options=options, run_metadata=metadata)
+        trace = timeline.Timeline(metadata.step_stats).generate_chrome_trace_format()
+        with open(os.path.join(self.trace_dir, 'step_{:06d}_{}.json'.format(step, name)), 'w') as f:
+            f.write(trace)
+        return out
@@ -0,0 +1,44 @@
+import time
+start_time = time.time()
+
+import argparse
+import json
+import os
+
+import tensorflow as tf
+
+from model import DCGAN
+from sampling import sample_images
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--imgSize', type=int, default=64)
+parser.add_argument('--checkpointDir', type=str, default='checkpoint')
+parser.add_argument('--nSamples', type=int, default=1024)
+parser.add_argument('--batchSize', type=int, default=256)
+parser.add_argument('--seed', type=int, default=None)
+parser.add_argument('--sweepSteps', type=int, default=0)
+parser.add_argument('--outDir', type=str, default='generated')
+parser.add_argument('--packed', action='store_true')
+parser.add_argument('--shardSize', type=int, default=4096)
+parser.add_argument('--writers', type=int, default=4)
+parser.add_argument('--prefetch', type=int, default=4)
+parser.add_argument('--stats', type=str, default=None)
+
+args = parser.parse_args()
+if not os.path.exists(args.outDir):
+    os.makedirs(args.outDir)
+
+config = tf.ConfigProto(allow_soft_placement = True)
+config.gpu_options.allow_growth = True
+with tf.device('/gpu:0'):
+    with tf.Session(config=config) as sess:
+        dcgan = DCGAN(sess, image_size=args.imgSize, batch_size=args.batchSize, checkpoint_dir=args.checkpointDir,
+                      inference=True)
+        isLoaded = dcgan.load(args.checkpointDir)
+        assert isLoaded
+        print("[Startup] model ready {:.2f}s after launch".format(time.time() - start_time))
+        stats = sample_images(dcgan, args)
+
+if args.stats:
+    with open(args.stats, 'w') as f:
+        json.dump(stats, f, indent=1)
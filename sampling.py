@@ -0,0 +1,109 @@
+from __future__ import division
+
+import os
+import threading
+import time
+
+import numpy as np
+from six.moves import queue, xrange
+
+from dataset import write_packed
+from writer import ImageWriter
+
+
+def latent_batches(n, batch_size, z_dim, seed=None, sweep_steps=0):
+    # z for `n` samples, `batch_size` at a time. With `sweep_steps`, every run
+    # of that many samples walks in a straight line between two random
+    # endpoints. The stream depends only on the seed, not on batch_size.
+    rng = np.random.RandomState(seed)
+    ends = {}
+    for start in xrange(0, n, batch_size):
+        count = min(batch_size, n - start)
+        if not sweep_steps:
+            yield rng.uniform(-1, 1, size=(count, z_dim)).astype(np.float32)
+            continue
+        k = np.arange(start, start + count)
+        sweep = k // sweep_steps
+        for s in xrange(sweep[0], sweep[-1] + 1):
+            if s not in ends:
+                ends[s] = rng.uniform(-1, 1, size=(2, z_dim))
+        t = (k % sweep_steps / max(sweep_steps - 1, 1))[:, None]
+        a = np.stack([ends[s][0] for s in sweep])
+        b = np.stack([ends[s][1] for s in sweep])
+        for s in list(ends):
+            if s < sweep[-1]:
+                del ends[s]
+        yield ((1 - t) * a + t * b).astype(np.float32)
+
+
+def sample_images(dcgan, config):
+    # Streams config.nSamples generator outputs to config.outDir, either as
+    # numbered PNGs or, with config.packed, as a packed dataset. z is drawn on
+    # one thread and images are encoded and written on others while the
+    # generator runs.
+    n = config.nSamples
+    z_queue = queue.Queue(config.prefetch)
+    out_queue = queue.Queue(config.prefetch)
+
+    def produce():
+        for z in latent_batches(n, config.batchSize, dcgan.z_dim, config.seed, config.sweepSteps):
+            z_queue.put(z)
+        z_queue.put(None)
+
+    result = {}
+
+    def images():
+        k = 0
+        while True:
+            batch = out_queue.get()
+            if batch is None:
+                result['drained'] = True
+                return
+            for image in np.clip(np.rint((batch + 1.) * 127.5), 0, 255).astype(np.uint8):
+                yield 'sample_{:08d}'.format(k), image
+                k += 1
+
+    def write():
+        try:
+            result['index'] = write_packed(config.outDir, images(), dcgan.image_size, config.shardSize)
+        except Exception as e:
+            result['error'] = e
+            # Keep the generator loop from blocking on a full queue.
+            while not result.get('drained') and out_queue.get() is not None:
+                pass
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    if config.packed:
+        writer = threading.Thread(target=write)
+        writer.start()
+    else:
+        writer = ImageWriter(config.writers, config.prefetch * config.batchSize)
+
+    start_time = time.time()
+    done = 0
+    while True:
+        z = z_queue.get()
+        if z is None:
+            break
+        G = dcgan.sess.run(dcgan.G, feed_dict={dcgan.z: z, dcgan.is_training: False})
+        if config.packed:
+            out_queue.put(G)
+        else:
+            for i in xrange(len(G)):
+                writer.save_images(G[i:i + 1], [1, 1], os.path.join(config.outDir, '{:08d}.png'.format(done + i)))
+        done += len(G)
+
+    if config.packed:
+        out_queue.put(None)
+        writer.join()
+        if 'error' in result:
+            raise result['error']
+    else:
+        writer.close()
+
+    elapsed = time.time() - start_time
+    stats = {'images': done, 'seconds': elapsed, 'images_per_sec': done / max(elapsed, 1e-9)}
+    print("[Sample] {images:d} images in {seconds:.2f}s ({images_per_sec:.2f} images/sec)".format(**stats))
+    return stats
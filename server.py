@@ -0,0 +1,177 @@
+from __future__ import division
+
+import collections
+import io
+import json
+import threading
+import time
+
+import numpy as np
+import scipy.misc
+from six.moves import BaseHTTPServer, queue, socketserver
+
+from utils import imread, inverse_transform, transform
+
+
+# Owns the Completer and is the only thread that touches the session.
+# Requests arriving while the engine is idle are gathered for up to `window`
+# seconds so the first batch starts full; later arrivals join the running
+# batch as slots free up.
+class CompletionService(object):
+    def __init__(self, completer, window=0.01):
+        self.completer = completer
+        self.window = window
+        self.inbox = queue.Queue()
+        self.latencies = collections.deque(maxlen=1000)
+        self.served = 0
+        self.in_flight = 0
+        self.failed = 0
+        self._requests = {}
+        self._next_key = 0
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, image):
+        request = {'image': image, 'done': threading.Event(), 'start': time.time()}
+        with self._lock:
+            self.in_flight += 1
+        self.inbox.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['result']
+
+    def _accept(self, request):
+        def done(key, image):
+            request['result'] = image
+            with self._lock:
+                del self._requests[key]
+                self.in_flight -= 1
+                self.served += 1
+                self.latencies.append(time.time() - request['start'])
+            request['done'].set()
+
+        key = self._next_key
+        self._next_key += 1
+        with self._lock:
+            self._requests[key] = request
+        try:
+            self.completer.add_image(key, request['image'], done, name='request {}'.format(key))
+        except Exception as e:
+            request['error'] = e
+            with self._lock:
+                self._requests.pop(key, None)
+                self.in_flight -= 1
+                self.failed += 1
+            request['done'].set()
+
+    def _loop(self):
+        while True:
+            try:
+                self._serve()
+            except Exception as e:
+                # A failed step cannot be pinned on one request: fail the
+                # requests in the engine, reset it and keep serving the rest.
+                with self._lock:
+                    requests = list(self._requests.values())
+                    self._requests.clear()
+                    self.in_flight -= len(requests)
+                    self.failed += len(requests)
+                self.completer.clear()
+                for request in requests:
+                    request['error'] = e
+                    request['done'].set()
+
+    def _serve(self):
+        while True:
+            if not self.completer.pending():
+                self._accept(self.inbox.get())
+                deadline = time.time() + self.window
+                while True:
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        self._accept(self.inbox.get(timeout=timeout))
+                    except queue.Empty:
+                        break
+            while True:
+                try:
+                    self._accept(self.inbox.get_nowait())
+                except queue.Empty:
+                    break
+            self.completer.step()
+
+    def metrics(self):
+        with self._lock:
+            latencies = np.array(self.latencies)
+            metrics = {
+                'in_flight': self.in_flight,
+                'served': self.served,
+                'failed': self.failed,
+                'queued_requests': self.inbox.qsize(),
+                'queued_tiles': len(self.completer.scheduler),
+                'active_slots': sum(slot is not None for slot in self.completer.slots),
+            }
+        if len(latencies):
+            p50, p95 = np.percentile(latencies, [50, 95])
+            metrics.update({'latency_p50': p50, 'latency_p95': p95, 'latency_max': latencies.max()})
+        metrics.update(self.completer.report())
+        return metrics
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(service, image_size, is_crop, c_dim=3):
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def _send(self, code, body, content_type):
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != '/metrics':
+                return self._send(404, b'not found\n', 'text/plain')
+            self._send(200, json.dumps(service.metrics(), indent=1).encode(), 'application/json')
+
+        def do_POST(self):
+            if self.path != '/complete':
+                return self._send(404, b'not found\n', 'text/plain')
+            try:
+                length = int(self.headers['Content-Length'])
+                if length < 0:
+                    raise ValueError(length)
+            except (TypeError, ValueError):
+                return self._send(400, b'missing or invalid Content-Length\n', 'text/plain')
+            body = self.rfile.read(length)
+            try:
+                image = transform(imread(io.BytesIO(body)), image_size, is_crop)
+            except Exception as e:
+                return self._send(400, 'cannot decode image: {}\n'.format(e).encode(), 'text/plain')
+            if image.ndim != 3 or image.shape[2] != c_dim or min(image.shape[:2]) < image_size:
+                return self._send(400, 'image must be at least {0}x{0}x{1}, got {2}\n'.format(
+                    image_size, c_dim, 'x'.join(map(str, image.shape))).encode(), 'text/plain')
+
+            try:
+                result = service.submit(image)
+            except Exception as e:
+                return self._send(500, 'completion failed: {}\n'.format(e).encode(), 'text/plain')
+            out = io.BytesIO()
+            scipy.misc.imsave(out, (255 * inverse_transform(result)).astype(np.uint8), format='png')
+            self._send(200, out.getvalue(), 'image/png')
+
+    return Handler
+
+
+def serve(completer, address, image_size=64, is_crop=False, window=0.01):
+    host, port = address.rsplit(':', 1)
+    service = CompletionService(completer, window=window)
+    httpd = ThreadingHTTPServer((host, int(port)), make_handler(service, image_size, is_crop, completer.dcgan.c_dim))
+    print("[Serve] listening on http://{}:{} (POST /complete, GET /metrics)".format(host, port))
+    httpd.serve_forever()
@@ -0,0 +1,98 @@
+from __future__ import division
+
+import numpy as np
+import scipy.misc
+from PIL import Image
+from six.moves import xrange
+
+# Largest encoded (non-.npy) source TiledImage.load will decode. Decoding is
+# not bounded, so anything bigger has to come in as .npy.
+MAX_DECODE_PIXELS = 64 * 2 ** 20
+
+
+# A 2-D (optionally channelled) array kept block-major in one memory-mapped
+# .npy file. A small window touches at most a few contiguous blocks however
+# wide the array is, so only the blocks in use are paged in. Indexing supports
+# plain [x0:x1, y0:y1] windows.
+class TiledArray(object):
+    def __init__(self, path, shape, dtype=np.uint8, block=256):
+        self.path = path
+        self.shape = tuple(shape)
+        self.block = block
+        self.grid = (-(-self.shape[0] // block), -(-self.shape[1] // block))
+        self.blocks = np.lib.format.open_memmap(path, mode='w+', dtype=dtype,
+                                                shape=self.grid + (block, block) + self.shape[2:])
+
+    def _window(self, key):
+        x0, x1, _ = key[0].indices(self.shape[0])
+        y0, y1, _ = key[1].indices(self.shape[1])
+        return x0, x1, y0, y1
+
+    def _runs(self, lo, hi):
+        # (block, start and stop inside the block, start and stop inside the window)
+        b = self.block
+        for i in xrange(lo // b, -(-hi // b)):
+            start, stop = max(lo, i * b), min(hi, (i + 1) * b)
+            yield i, start - i * b, stop - i * b, start - lo, stop - lo
+
+    def read(self, x0, x1, y0, y1):
+        out = np.empty((x1 - x0, y1 - y0) + self.shape[2:], dtype=self.blocks.dtype)
+        for i, a0, a1, o0, o1 in self._runs(x0, x1):
+            for j, b0, b1, p0, p1 in self._runs(y0, y1):
+                out[o0:o1, p0:p1] = self.blocks[i, j, a0:a1, b0:b1]
+        return out
+
+    def write(self, x0, x1, y0, y1, value):
+        value = np.broadcast_to(value, (x1 - x0, y1 - y0) + self.shape[2:])
+        for i, a0, a1, o0, o1 in self._runs(x0, x1):
+            for j, b0, b1, p0, p1 in self._runs(y0, y1):
+                self.blocks[i, j, a0:a1, b0:b1] = value[o0:o1, p0:p1]
+
+    def __getitem__(self, key):
+        return self.read(*self._window(key))
+
+    def __setitem__(self, key, value):
+        self.write(*(self._window(key) + (value,)))
+
+    def export(self, path):
+        # Row-major .npy copy, written one row of blocks at a time.
+        out = np.lib.format.open_memmap(path, mode='w+', dtype=self.blocks.dtype, shape=self.shape)
+        for i in xrange(self.grid[0]):
+            x0, x1 = i * self.block, min((i + 1) * self.block, self.shape[0])
+            out[x0:x1] = self.read(x0, x1, 0, self.shape[1])
+        out.flush()
+        del out
+
+
+# uint8 image store that reads and writes [-1, 1] floats like utils.transform,
+# so the completion engine can use it in place of an in-memory image.
+class TiledImage(TiledArray):
+    def __getitem__(self, key):
+        return TiledArray.__getitem__(self, key).astype(np.float32) / 127.5 - 1.
+
+    def __setitem__(self, key, value):
+        value = np.clip(np.rint((np.asarray(value) + 1.) * 127.5), 0, 255).astype(np.uint8)
+        TiledArray.__setitem__(self, key, value)
+
+    @classmethod
+    def load(cls, source, path, block=256):
+        # .npy sources are memory-mapped; other formats are decoded to uint8
+        # whole, so they are capped at MAX_DECODE_PIXELS (read from the header
+        # before decoding), and then copied in one row of blocks at a time.
+        if source.endswith('.npy'):
+            pixels = np.load(source, mmap_mode='r')
+        else:
+            width, height = Image.open(source).size
+            if width * height > MAX_DECODE_PIXELS:
+                raise ValueError(
+                    "{} is {}x{}, over the {} pixel limit for decoding encoded images out of core; "
+                    "convert it once to a uint8 RGB .npy of shape ({}, {}, 3) with a tool that "
+                    "decodes in strips and pass the .npy instead".format(
+                        source, width, height, MAX_DECODE_PIXELS, height, width))
+            pixels = scipy.misc.imread(source, mode='RGB')
+        image = cls(path, pixels.shape, block=block)
+        for i in xrange(image.grid[0]):
+            x0, x1 = i * block, min((i + 1) * block, image.shape[0])
+            image.write(x0, x1, 0, image.shape[1], pixels[x0:x1])
+        image.blocks.flush()
+        return image
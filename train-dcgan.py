@@ -12,8 +12,23 @@ flags.DEFINE_float("beta1", 0.5, "Momentum term of adam [0.5]")
 flags.DEFINE_float("train_size", np.inf, "The size of train images [np.inf]")
 flags.DEFINE_integer("batch_size", 64, "The size of batch images [64]")
 flags.DEFINE_integer("image_size", 64, "The size of image to use")
-flags.DEFINE_string("dataset", "lfw-aligned-64", "Dataset directory.")
+flags.DEFINE_string("dataset", "lfw-aligned-64", "Dataset directory of images, or a packed dataset written by build-dataset.py or extract-patches.py.")
 flags.DEFINE_string("checkpoint_dir", "checkpoint", "Directory name to save the checkpoints [checkpoint]")
+flags.DEFINE_integer("num_towers", 1, "Split each batch across N data-parallel model replicas and average their gradients [1]")
+flags.DEFINE_integer("intra_op_threads", 0, "Threads used inside a single op, 0 for the TensorFlow default [0]")
+flags.DEFINE_integer("inter_op_threads", 0, "Ops run concurrently, e.g. one per tower; 0 for the TensorFlow default [0]")
+flags.DEFINE_integer("checkpoint_interval", 500, "Save a checkpoint every N steps [500]")
+flags.DEFINE_integer("checkpoint_keep", 5, "Number of most recent checkpoints to keep [5]")
+flags.DEFINE_float("checkpoint_keep_hours", 10000., "Also keep one checkpoint per this many hours of training [10000]")
+flags.DEFINE_integer("loader_workers", 4, "Number of threads decoding training batches [4]")
+flags.DEFINE_integer("prefetch_batches", 8, "Number of decoded batches buffered ahead of the optimizer [8]")
+flags.DEFINE_integer("summary_interval", 100, "Write merged summaries every N steps [100]")
+flags.DEFINE_boolean("exact_logging", False, "Evaluate losses with separate post-update passes and write summaries every step [False]")
+flags.DEFINE_integer("profile_interval", 100, "Print a per-phase timing breakdown every N steps, 0 to disable [100]")
+flags.DEFINE_integer("profile_window", 100, "Number of recent steps the p50/p95 timings cover [100]")
+flags.DEFINE_integer("trace_start", 10, "First step captured by the TensorFlow timeline trace [10]")
+flags.DEFINE_integer("trace_steps", 0, "Number of steps to capture as timeline traces, 0 to disable [0]")
+flags.DEFINE_string("trace_dir", "traces", "Directory for timeline trace files [traces]")
 flags.DEFINE_string("sample_dir", "samples", "Directory name to save the image samples [samples]")
 FLAGS = flags.FLAGS
 
@@ -22,7 +37,9 @@ if not os.path.exists(FLAGS.checkpoint_dir):
 if not os.path.exists(FLAGS.sample_dir):
     os.makedirs(FLAGS.sample_dir)
 
-config = tf.ConfigProto(allow_soft_placement = True)
+config = tf.ConfigProto(allow_soft_placement = True,
+                        intra_op_parallelism_threads=FLAGS.intra_op_threads,
+                        inter_op_parallelism_threads=FLAGS.inter_op_threads)
 config.gpu_options.allow_growth = True
 
 with tf.device('/gpu:0'):
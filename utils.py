@@ -22,14 +22,12 @@ def imread(path):
 
 
 def merge(images, size):
-    h, w = images.shape[1], images.shape[2]
-    img = np.zeros((int(h * size[0]), int(w * size[1]), 3))
-    for idx, image in enumerate(images):
-        i = idx % size[1]
-        j = idx // size[1]
-        img[j * h:j * h + h, i * w:i * w + w, :] = image
-
-    return img
+    rows, cols = int(size[0]), int(size[1])
+    n, h, w = images.shape[:3]
+    grid = np.zeros((rows * cols,) + images.shape[1:])
+    grid[:n] = images[:rows * cols]
+    grid = grid.reshape(rows, cols, h, w, -1).transpose(0, 2, 1, 3, 4)
+    return grid.reshape(rows * h, cols * w, -1)
 
 
 def imsave(images, size, path):
@@ -58,3 +56,8 @@ def inverse_transform(images):
     return (images + 1.) / 2.
 
 
+def hole_pixels(image, epsilon=0.7):
+    # True where the pixel is magenta (1, -1, 1) in [-1, 1] space.
+    return ((np.abs(image[..., 0] - 1.0) <= epsilon) &
+            (np.abs(image[..., 1] + 1.0) <= epsilon) &
+            (np.abs(image[..., 2] - 1.0) <= epsilon))
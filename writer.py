@@ -0,0 +1,125 @@
+from __future__ import division
+
+import atexit
+import os
+import threading
+import time
+
+import numpy as np
+from six.moves import queue, xrange
+
+import utils
+
+
+# Encodes and writes image grids on worker threads. `save_images` copies the
+# batch and returns at once; it only waits when `queue_depth` grids are already
+# pending, and that time is accumulated in `wait_time`. Errors raised by a
+# worker surface on the next `save_images` or `flush`.
+#
+# Each file is encoded to a temporary name and renamed into place, and when
+# one path is saved several times the most recently submitted version wins,
+# whichever worker finishes last.
+class ImageWriter(object):
+    def __init__(self, num_workers=2, queue_depth=16):
+        self.wait_time = 0.0
+        self.written = 0
+
+        self._queue = queue.Queue(max(1, queue_depth))
+        self._error = None
+        self._lock = threading.Lock()
+        # Per path: last submitted and last renamed sequence number, and the
+        # number of versions still in flight.
+        self._submitted = {}
+        self._renamed = {}
+        self._pending = {}
+        self._workers = [threading.Thread(target=self._work) for _ in xrange(max(1, num_workers))]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                self._write(*job)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _write(self, images, size, path, seq):
+        head, tail = os.path.split(path)
+        base, ext = os.path.splitext(tail)
+        tmp = os.path.join(head, '.{}.{:d}.tmp{}'.format(base, seq, ext))
+        try:
+            utils.save_images(images, size, tmp)
+            with self._lock:
+                if seq > self._renamed.get(path, -1):
+                    replace(tmp, path)
+                    self._renamed[path] = seq
+                    self.written += 1
+                    tmp = None
+        finally:
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+            with self._lock:
+                self._pending[path] -= 1
+                if not self._pending[path]:
+                    del self._pending[path], self._submitted[path]
+                    self._renamed.pop(path, None)
+
+    def _check(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def save_images(self, images, size, path):
+        self._check()
+        with self._lock:
+            seq = self._submitted[path] = self._submitted.get(path, -1) + 1
+            self._pending[path] = self._pending.get(path, 0) + 1
+        job = (np.array(images, copy=True), size, path, seq)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            start = time.time()
+            self._queue.put(job)
+            self.wait_time += time.time() - start
+
+    def flush(self):
+        self._queue.join()
+        self._check()
+
+    def close(self):
+        self.flush()
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+
+# Atomic over an existing file on POSIX and, where available, Windows.
+replace = getattr(os, 'replace', os.rename)
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def default_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = ImageWriter()
+            atexit.register(_writer.flush)
+        return _writer
+
+
+def save_images(images, size, image_path):
+    default_writer().save_images(images, size, image_path)
+
+
+def flush_images():
+    if _writer is not None:
+        _writer.flush()